@@ -0,0 +1,1042 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+下载器性能测试
+使用本地HTTP服务器模拟视频源，不需要访问YouTube
+
+--scenario suite 运行回归测试：用模拟的视频网站（FakeSiteHandler 和 FakeSiteIE）
+测量单个视频、HLS分片、1000个视频的播放列表、崩溃后继续和错误注入几种场景，
+可以把结果保存为基线，之后与基线比较，退步超过容差时退出码为 1。
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import itertools
+import collections
+import threading
+import contextlib
+import subprocess
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import downloader
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """提供合成视频文件的请求处理器，每个连接按固定带宽发送数据"""
+
+    file_size = 512 * 1024
+    bandwidth = 1024 * 1024  # 每个连接的字节/秒
+    latency = 0.0
+    chunk_size = 16 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_headers(self, start=0):
+        if start:
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{self.file_size - 1}/{self.file_size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(self.file_size - start))
+        self.end_headers()
+
+    def _range_start(self):
+        value = self.headers.get('Range', '')
+        if value.startswith('bytes='):
+            start = value[len('bytes='):].split('-')[0]
+            if start.isdigit() and int(start) < self.file_size:
+                return int(start)
+        return 0
+
+    def do_HEAD(self):
+        time.sleep(self.latency)
+        self._send_headers()
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        start = self._range_start()
+        self._send_headers(start)
+        self.send_body(self.file_size - start)
+
+    def send_body(self, length):
+        """按带宽限制发送 length 字节，返回实际写入的字节数"""
+        chunk = b'\0' * self.chunk_size
+        sent = 0
+        started = time.monotonic()
+        try:
+            while sent < length:
+                n = min(self.chunk_size, length - sent)
+                self.count_bytes(n)
+                self.wfile.write(chunk[:n])
+                sent += n
+                # 按带宽限制发送速度
+                delay = sent / self.bandwidth - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        return sent
+
+    def count_bytes(self, n):
+        """发送数据前调用，用于统计传输量"""
+
+
+class FlakyMediaHandler(MediaHandler):
+    """每个连接发送 drop_after 字节后断开，并统计总共发送的字节数"""
+
+    file_size = 4 * 1024 * 1024
+    bandwidth = 8 * 1024 * 1024
+    drop_after = 1024 * 1024
+    bytes_sent = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        start = self._range_start()
+        self._send_headers(start)
+        self.send_body(min(self.drop_after, self.file_size - start))
+        # 不发送剩余数据，直接断开连接
+        self.close_connection = True
+
+    def count_bytes(self, n):
+        with self.lock:
+            FlakyMediaHandler.bytes_sent += n
+
+
+class SegmentedMediaHandler(MediaHandler):
+    """提供HLS媒体播放列表和分片，每个请求有固定延迟，模拟高延迟链路"""
+
+    segments = 40
+    segment_size = 64 * 1024
+    latency = 0.05
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        path = self.path.split('?')[0]
+        if path.endswith('.m3u8'):
+            lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2',
+                     '#EXT-X-MEDIA-SEQUENCE:0']
+            for i in range(self.segments):
+                lines += ['#EXTINF:2.0,', f'seg{i}.ts']
+            lines.append('#EXT-X-ENDLIST')
+            body = ('\n'.join(lines) + '\n').encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Content-Length', str(self.segment_size))
+        self.end_headers()
+        self.send_body(self.segment_size)
+
+
+@contextlib.contextmanager
+def media_server(handler=MediaHandler):
+    """在后台线程中启动本地HTTP服务器"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_playlist(base_url, count):
+    """构造指向本地服务器的播放列表信息"""
+    return {
+        'id': 'bench',
+        'title': 'benchmark',
+        'videos': [
+            {
+                'id': f'v{i}',
+                'title': f'v{i}',
+                'url': f"{base_url}/v{i}.mp4",
+                'status': 'pending'
+            }
+            for i in range(count)
+        ]
+    }
+
+
+def bench_playlist_workers(count, worker_counts):
+    """测量不同并发数下播放列表的下载吞吐量"""
+    results = []
+    with media_server() as base_url:
+        for workers in worker_counts:
+            output_path = tempfile.mkdtemp(prefix='ytdl-bench-')
+            state_dir = tempfile.mkdtemp(prefix='ytdl-state-')
+            cwd = os.getcwd()
+            os.chdir(state_dir)
+            try:
+                playlist_info = make_playlist(base_url, count)
+                started = time.monotonic()
+                with contextlib.redirect_stdout(io.StringIO()), \
+                        contextlib.redirect_stderr(io.StringIO()):
+                    ok = downloader.download_playlist(
+                        playlist_info, 'best', output_path, workers=workers,
+                        rate_limiter=downloader.RateLimiter(rate=count, window=1, burst=count)
+                    )
+                elapsed = time.monotonic() - started
+            finally:
+                os.chdir(cwd)
+                shutil.rmtree(output_path, ignore_errors=True)
+                shutil.rmtree(state_dir, ignore_errors=True)
+            total_bytes = count * MediaHandler.file_size
+            results.append((workers, elapsed, total_bytes / elapsed, ok))
+    return results
+
+
+class SmallMediaHandler(MediaHandler):
+    """不限速的小文件，使测量结果以每个视频的初始化开销为主"""
+
+    file_size = 16 * 1024
+    bandwidth = float('inf')
+
+
+def bench_session_reuse(count):
+    """比较每个视频新建下载器与复用 DownloadSession 的单视频开销"""
+    results = {}
+    with media_server(SmallMediaHandler) as base_url:
+        urls = [f"{base_url}/s{i}.mp4" for i in range(count)]
+        output_path = tempfile.mkdtemp(prefix='ytdl-bench-')
+        try:
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                started = time.monotonic()
+                for url in urls:
+                    downloader.download_video(url, 'best', output_path)
+                results['每个视频新建'] = (time.monotonic() - started) / count
+
+                started = time.monotonic()
+                with downloader.DownloadSession() as session:
+                    for url in urls:
+                        downloader.download_video(url, 'best', output_path, session=session)
+                results['复用会话'] = (time.monotonic() - started) / count
+        finally:
+            shutil.rmtree(output_path, ignore_errors=True)
+    return results
+
+
+def bench_state_writes(entries, sample=200):
+    """比较每次重写完整状态文件与追加日志的写入字节数和耗时
+
+    完整重写的代价与条目数的平方成正比，只实际执行前 sample 次写入，
+    其余按每次写入的平均值估算。
+    """
+    state_dir = tempfile.mkdtemp(prefix='ytdl-state-')
+    filename = os.path.join(state_dir, 'download_state.json')
+    try:
+        state = {
+            'playlist_id': 'bench',
+            'playlist_title': 'benchmark',
+            'format_id': 'best',
+            'output_path': None,
+            'total_videos': entries,
+            'videos': make_playlist('https://www.youtube.com', entries)['videos']
+        }
+
+        # 每个视频完成后重写整个文件
+        written = 0
+        started = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for i in range(min(sample, entries)):
+                state['videos'][i]['status'] = 'completed'
+                downloader.save_download_state(state, filename)
+                written += os.path.getsize(filename)
+        scale = entries / min(sample, entries)
+        rewrite = (written * scale, (time.monotonic() - started) * scale)
+
+        for video in state['videos']:
+            video['status'] = 'pending'
+
+        # 追加日志
+        started = time.monotonic()
+        with downloader.StateJournal(state, filename) as journal:
+            for i in range(entries):
+                journal.record(i, status='completed')
+        journal_result = (journal.bytes_written, time.monotonic() - started)
+
+        loaded = downloader.load_download_state(filename)
+        assert all(v['status'] == 'completed' for v in loaded['videos'])
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+    return {'完整重写(估算)': rewrite, '追加日志': journal_result}
+
+
+def bench_resume():
+    """测量连接中途断开以及下载被中断后，总传输量与文件大小的比值"""
+    results = {}
+    output_path = tempfile.mkdtemp(prefix='ytdl-bench-')
+    try:
+        with media_server(FlakyMediaHandler) as base_url, \
+                contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()):
+            # 服务器每发送 drop_after 字节断开一次
+            FlakyMediaHandler.bytes_sent = 0
+            result = downloader.download_video(f"{base_url}/flaky.mp4", 'best', output_path)
+            results['连接断开'] = (result, FlakyMediaHandler.bytes_sent)
+
+            # 下载到一半时中断，之后重新下载
+            FlakyMediaHandler.bytes_sent = 0
+            stop_event = threading.Event()
+
+            def stop_halfway(d):
+                if d.get('downloaded_bytes', 0) >= FlakyMediaHandler.file_size // 2:
+                    stop_event.set()
+
+            hooks = [stop_halfway, downloader.make_worker_progress_hook('bench', stop_event)]
+            try:
+                downloader.download_video(f"{base_url}/interrupted.mp4", 'best', output_path,
+                                          progress_hooks=hooks)
+            except downloader.yt_dlp.utils.DownloadCancelled:
+                pass
+            result = downloader.download_video(f"{base_url}/interrupted.mp4", 'best', output_path)
+            results['中断后继续'] = (result, FlakyMediaHandler.bytes_sent)
+    finally:
+        shutil.rmtree(output_path, ignore_errors=True)
+    return results
+
+
+def bench_fragments(fragment_counts, count=2):
+    """测量分片格式在不同的分片并发数下的下载速度"""
+    results = []
+    with media_server(SegmentedMediaHandler) as base_url:
+        for fragments in fragment_counts:
+            output_path = tempfile.mkdtemp(prefix='ytdl-bench-')
+            try:
+                with contextlib.redirect_stdout(io.StringIO()), \
+                        contextlib.redirect_stderr(io.StringIO()), \
+                        downloader.DownloadSession(False, fragments=fragments) as session:
+                    # 合成的分片不是真正的视频，不需要 ffmpeg 修复
+                    session.ydl.params['fixup'] = 'never'
+                    started = time.monotonic()
+                    ok = all(downloader.download_video(f"{base_url}/f{fragments}_{i}.m3u8", 'best',
+                                                       output_path, session=session) == 0
+                             for i in range(count))
+                    elapsed = time.monotonic() - started
+            finally:
+                shutil.rmtree(output_path, ignore_errors=True)
+            total_bytes = count * SegmentedMediaHandler.segments * SegmentedMediaHandler.segment_size
+            results.append((fragments, elapsed, total_bytes / elapsed, ok))
+    return results
+
+
+class FakeSiteHandler(MediaHandler):
+    """模拟的视频网站
+
+    /api/video/<id> 返回视频信息，/api/playlist/<n>?page=<k> 分页返回有 n 个视频的
+    播放列表，/media/<id>.mp4 为整段文件，/media/<id>.m3u8 为HLS播放列表及其分片。
+    每个请求先等待 latency 秒；路径以 error_paths 中任一项开头的请求有 error_rate
+    比例返回 error_status，drop_rate 比例的媒体请求发送一半后断开。是否出错由 seed、
+    请求路径和该路径被请求的次数决定，与线程调度无关，每次运行注入的错误相同。
+    用 configure 创建带参数的子类，每个子类的统计数据相互独立。
+    """
+
+    file_size = 256 * 1024
+    bandwidth = 4 * 1024 * 1024
+    segments = 8
+    page_size = 100
+    duration = 60
+    error_rate = 0.0
+    error_status = 500
+    error_paths = ('/api/', '/media/')
+    drop_rate = 0.0
+    seed = 0
+    # 统计数据：发送的媒体字节数、注入的错误数、返回错误的请求路径、
+    # 每个视频最后一次完整发送媒体数据的时间
+    bytes_sent = 0
+    errors = 0
+    error_log = []
+    finished = {}
+    lock = threading.Lock()
+    rolls = collections.Counter()
+
+    @classmethod
+    def configure(cls, **options):
+        """返回带有指定参数和独立统计数据的子类"""
+        stats = {
+            'bytes_sent': 0,
+            'errors': 0,
+            'error_log': [],
+            'finished': {},
+            'lock': threading.Lock(),
+            'rolls': collections.Counter(),
+        }
+        return type(cls.__name__, (cls,), {**options, **stats})
+
+    def count_bytes(self, n):
+        with self.lock:
+            type(self).bytes_sent += n
+
+    def _roll(self, rate, kind):
+        if rate <= 0:
+            return False
+        with self.lock:
+            self.rolls[kind, self.path] += 1
+            n = self.rolls[kind, self.path]
+        return random.Random(f"{self.seed}:{kind}:{self.path}:{n}").random() < rate
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_media(self, video_id, length):
+        """发送媒体数据，按 drop_rate 中途断开；完整发送时记录完成时间"""
+        if self._roll(self.drop_rate, 'drop'):
+            self.send_body(length // 2)
+            self.close_connection = True
+        elif self.send_body(length) == length:
+            with self.lock:
+                self.finished[video_id] = time.monotonic()
+
+    def video_info(self, base_url, video_id):
+        """视频信息：整段文件和HLS两种格式，大小相同"""
+        codecs = {'vcodec': 'avc1.4d401f', 'acodec': 'mp4a.40.2'}
+        return {
+            'id': video_id,
+            'title': f"video {video_id}",
+            'duration': self.duration,
+            'formats': [
+                {'format_id': 'progressive', 'url': f"{base_url}/media/{video_id}.mp4", 'ext': 'mp4',
+                 'filesize': self.file_size, **codecs},
+                {'format_id': 'hls', 'url': f"{base_url}/media/{video_id}.m3u8", 'ext': 'mp4',
+                 'protocol': 'm3u8_native', 'filesize_approx': self.file_size, **codecs},
+            ],
+        }
+
+    def playlist_page(self, count, page):
+        start = page * self.page_size
+        ids = range(start, min(count, start + self.page_size))
+        return {
+            'entries': [{'id': f"v{i}", 'title': f"video v{i}"} for i in ids],
+            'next': start + self.page_size < count,
+        }
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self.path.startswith(self.error_paths) and self._roll(self.error_rate, 'error'):
+            with self.lock:
+                type(self).errors += 1
+                self.error_log.append(self.path)
+            self.send_error(self.error_status)
+            return
+        path, _, query = self.path.partition('?')
+        match = re.fullmatch(r'/api/video/([\w-]+)', path)
+        if match:
+            self._send_json(self.video_info(f"http://{self.headers['Host']}", match.group(1)))
+            return
+        match = re.fullmatch(r'/api/playlist/(\d+)', path)
+        if match:
+            page = re.search(r'page=(\d+)', query)
+            self._send_json(self.playlist_page(int(match.group(1)), int(page.group(1)) if page else 0))
+            return
+        match = re.fullmatch(r'/media/([\w-]+)\.m3u8', path)
+        if match:
+            lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2',
+                     '#EXT-X-MEDIA-SEQUENCE:0']
+            for i in range(self.segments):
+                lines += [f'#EXTINF:{self.duration / self.segments:.3f},', f'{match.group(1)}/seg{i}.ts']
+            lines.append('#EXT-X-ENDLIST')
+            body = ('\n'.join(lines) + '\n').encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        match = re.fullmatch(r'/media/([\w-]+)/seg(\d+)\.ts', path)
+        if match:
+            size = self.file_size // self.segments
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/mp2t')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            self._send_media(match.group(1), size)
+            return
+        match = re.fullmatch(r'/media/([\w-]+)\.mp4', path)
+        if match:
+            start = self._range_start()
+            self._send_headers(start)
+            self._send_media(match.group(1), self.file_size - start)
+            return
+        self.send_error(404)
+
+
+# FakeSiteIE 第一次提取每个视频的时间，与 FakeSiteHandler.finished 一起计算每个视频的延迟
+extract_times = {}
+_fake_site_ie = None
+
+
+def fake_site_ie():
+    """返回 FakeSiteIE：从 FakeSiteHandler 的 /api/ 获取信息的 yt-dlp 提取器
+
+    视频地址为 <服务器>/watch?v=<id>，播放列表地址为 <服务器>/playlist?list=<视频数量>，
+    播放列表按页获取，与真实网站一样边迭代边请求。
+    """
+    global _fake_site_ie
+    if _fake_site_ie is not None:
+        return _fake_site_ie
+    from yt_dlp.extractor.common import InfoExtractor
+
+    class FakeSiteIE(InfoExtractor):
+        IE_NAME = 'fakesite'
+        _VALID_URL = r'(?P<base>http://127\.0\.0\.1:\d+)/(?:watch\?v=(?P<id>[\w-]+)|playlist\?list=(?P<count>\d+))$'
+
+        def _real_extract(self, url):
+            base_url, video_id, count = self._match_valid_url(url).group('base', 'id', 'count')
+            if video_id:
+                extract_times.setdefault(video_id, time.monotonic())
+                return self._download_json(f"{base_url}/api/video/{video_id}", video_id)
+            return self.playlist_result(self._entries(base_url, count), f"list{count}", f"playlist {count}")
+
+        def _entries(self, base_url, count):
+            for page in itertools.count():
+                data = self._download_json(f"{base_url}/api/playlist/{count}?page={page}", f"list{count}",
+                                           note=f"Downloading page {page + 1}")
+                for entry in data['entries']:
+                    yield self.url_result(f"{base_url}/watch?v={entry['id']}", FakeSiteIE,
+                                          entry['id'], entry['title'])
+                if not data['next']:
+                    return
+
+    _fake_site_ie = FakeSiteIE
+    return FakeSiteIE
+
+
+@contextlib.contextmanager
+def fake_site_extractor():
+    """在 with 块中把 FakeSiteIE 放在 yt-dlp 提取器列表的最前面（否则通用提取器会先匹配）
+
+    较早的 yt-dlp 没有 yt_dlp.globals，提取器列表是 yt_dlp.extractor.extractors
+    模块中的 _ALL_CLASSES，按名称查找提取器时使用模块的属性。
+    """
+    ie = fake_site_ie()
+    try:
+        from yt_dlp.extractor import import_extractors
+        from yt_dlp.globals import extractors
+    except ImportError:
+        from yt_dlp.extractor import extractors as module
+        module._ALL_CLASSES.insert(0, ie)
+        setattr(module, ie.__name__, ie)
+        try:
+            yield ie
+        finally:
+            module._ALL_CLASSES.remove(ie)
+            delattr(module, ie.__name__)
+        return
+    import_extractors()
+    saved = extractors.value
+    extractors.value = {ie.__name__: ie, **saved}
+    try:
+        yield ie
+    finally:
+        extractors.value = saved
+
+
+@contextlib.contextmanager
+def fake_site(**options):
+    """启动模拟视频网站并注册 FakeSiteIE，产生 (服务器地址, 处理器类)
+
+    options 为 FakeSiteHandler 的参数，例如 latency、bandwidth、error_rate。
+    """
+    handler = FakeSiteHandler.configure(**options)
+    with fake_site_extractor(), media_server(handler) as base_url:
+        yield base_url, handler
+
+
+@contextlib.contextmanager
+def quiet_workdir():
+    """在临时目录中运行并隐藏输出，结束后删除目录"""
+    workdir = tempfile.mkdtemp(prefix='ytdl-suite-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            yield workdir
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def percentile(values, p):
+    """最近秩法计算百分位数，没有数据时返回 None"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def peak_rss():
+    """本进程的内存峰值（字节），不支持的平台返回 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KiB 为单位，macOS 以字节为单位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def bytes_written():
+    """本进程用 write 系统调用写入的字节数（文件和管道，不含网络），只支持 Linux"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def suite_result(ok, elapsed, transferred, latencies, written_before, **extra):
+    """回归测试场景的结果，各场景使用相同的指标"""
+    written = bytes_written()
+    return {
+        'ok': bool(ok),
+        'elapsed': elapsed,
+        'throughput': transferred / elapsed if elapsed else 0.0,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'peak_rss': peak_rss(),
+        'bytes_written': written - written_before if written is not None else None,
+        'bytes_transferred': transferred,
+        **extra
+    }
+
+
+def video_latencies(handler):
+    """每个视频从开始提取到最后一个字节发送完成的时间"""
+    return [handler.finished[i] - started for i, started in extract_times.items() if i in handler.finished]
+
+
+def permissive_rate_limiter(count):
+    """不限制开始下载频率的 RateLimiter，测试结果只反映下载本身"""
+    return downloader.RateLimiter(rate=count, window=1, burst=count)
+
+
+def suite_single(args, count=20):
+    """逐个下载整段文件的单个视频，测量每个视频的完整耗时"""
+    with fake_site(file_size=1024 * 1024, bandwidth=16 * 1024 * 1024, latency=0.02) as (base_url, handler), \
+            quiet_workdir():
+        written = bytes_written() or 0
+        latencies = []
+        ok = True
+        started = time.monotonic()
+        with downloader.DownloadSession(False) as session:
+            for i in range(count):
+                video_started = time.monotonic()
+                ok &= downloader.download_video(f"{base_url}/watch?v=s{i}", 'progressive', 'out',
+                                                session=session) == 0
+                latencies.append(time.monotonic() - video_started)
+        elapsed = time.monotonic() - started
+        return suite_result(ok, elapsed, handler.bytes_sent, latencies, written, videos=count)
+
+
+def suite_hls(args, count=4):
+    """下载高延迟链路上的HLS分片视频"""
+    with fake_site(file_size=2 * 1024 * 1024, segments=32, latency=0.03) as (base_url, handler), \
+            quiet_workdir():
+        written = bytes_written() or 0
+        latencies = []
+        ok = True
+        started = time.monotonic()
+        with downloader.DownloadSession(False) as session:
+            # 合成的分片不是真正的视频，不需要 ffmpeg 修复
+            session.ydl.params['fixup'] = 'never'
+            for i in range(count):
+                video_started = time.monotonic()
+                ok &= downloader.download_video(f"{base_url}/watch?v=h{i}", 'hls', 'out',
+                                                session=session) == 0
+                latencies.append(time.monotonic() - video_started)
+        elapsed = time.monotonic() - started
+        return suite_result(ok, elapsed, handler.bytes_sent, latencies, written, videos=count)
+
+
+def suite_playlist(args):
+    """获取并下载一个大播放列表（默认1000个小视频），以每个视频的固定开销和状态保存为主"""
+    count = args.playlist_size
+    with fake_site(file_size=16 * 1024, bandwidth=float('inf')) as (base_url, handler), quiet_workdir():
+        written = bytes_written() or 0
+        started = time.monotonic()
+        playlist_info = downloader.get_playlist_info(f"{base_url}/playlist?list={count}")
+        extract_seconds = time.monotonic() - started
+        ok = playlist_info is not None and len(playlist_info['videos']) == count and downloader.download_playlist(
+            playlist_info, 'progressive', 'out', workers=8, rate_limiter=permissive_rate_limiter(count),
+            state_path='state.json', progress=None
+        )
+        elapsed = time.monotonic() - started
+        return suite_result(ok, elapsed, handler.bytes_sent, video_latencies(handler), written,
+                            videos=count, extract_seconds=extract_seconds)
+
+
+def _crash_first_pass(url, workdir, count):
+    """在子进程中开始下载播放列表，由 suite_crash 中途强制结束"""
+    os.chdir(workdir)
+    with fake_site_extractor(), contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        playlist_info = downloader.get_playlist_info(url)
+        downloader.download_playlist(playlist_info, 'progressive', 'out', workers=4,
+                                     rate_limiter=permissive_rate_limiter(count),
+                                     state_path='state.json', progress=None)
+
+
+def suite_crash(args, count=20):
+    """下载到一半时强制结束进程，再从状态文件继续
+
+    计时和延迟只统计继续下载的部分；bytes_transferred 为两次合计，
+    transfer_ratio 为其与所有文件总大小之比，越接近 1 说明重复下载越少。
+    """
+    file_size = 1024 * 1024
+    with fake_site(file_size=file_size, bandwidth=2 * 1024 * 1024) as (base_url, handler), \
+            quiet_workdir() as workdir:
+        total = count * file_size
+        # 不用 fork，避免复制服务器线程
+        process = multiprocessing.get_context('spawn').Process(
+            target=_crash_first_pass, args=(f"{base_url}/playlist?list={count}", workdir, count))
+        process.start()
+        while process.is_alive() and handler.bytes_sent < total // 2:
+            time.sleep(0.02)
+        process.kill()
+        process.join()
+        first_pass = handler.bytes_sent
+
+        written = bytes_written() or 0
+        started = time.monotonic()
+        state = downloader.load_download_state('state.json')
+        ok = state is not None and downloader.download_playlist(
+            state, state.get('format_id'), state.get('output_path'), workers=4,
+            rate_limiter=permissive_rate_limiter(count), state_path='state.json', progress=None
+        )
+        elapsed = time.monotonic() - started
+        ok = ok and all(os.path.getsize(os.path.join('out', name)) == file_size
+                        for name in os.listdir('out'))
+        result = suite_result(ok, elapsed, handler.bytes_sent - first_pass, video_latencies(handler),
+                              written, videos=count, transfer_ratio=handler.bytes_sent / total)
+        result['bytes_transferred'] = handler.bytes_sent
+        return result
+
+
+def suite_errors(args, count=40):
+    """服务器随机返回错误或中途断开时下载播放列表，测量重试的代价
+
+    错误同时注入到信息（/api/）和媒体请求。获取信息出错的视频应在同一次运行中
+    重试并下载完成，failures 为不符合预期的项目。
+    """
+    # seed 决定哪些请求出错，选用的值会使几个视频的信息请求出错
+    with fake_site(file_size=256 * 1024, error_rate=0.05, drop_rate=0.1, latency=0.01,
+                   error_paths=('/api/', '/media/'), seed=2) as (base_url, handler), quiet_workdir():
+        written = bytes_written() or 0
+        started = time.monotonic()
+        playlist_info = downloader.get_playlist_info(f"{base_url}/playlist?list={count}")
+        ok = playlist_info is not None and downloader.download_playlist(
+            playlist_info, 'progressive', 'out', workers=4, rate_limiter=permissive_rate_limiter(count),
+            state_path='state.json', progress=None
+        )
+        elapsed = time.monotonic() - started
+        failures = [] if ok else [f"应在一次运行中下载完 {count} 个视频"]
+        api_errors = [path for path in handler.error_log if path.startswith('/api/video/')]
+        if not api_errors:
+            failures.append("没有向视频信息请求注入错误")
+        not_retried = sorted({path.rsplit('/', 1)[1] for path in api_errors} - set(handler.finished))
+        if not_retried:
+            failures.append(f"获取信息出错后没有重试: {', '.join(not_retried)}")
+        return suite_result(not failures, elapsed, handler.bytes_sent, video_latencies(handler), written,
+                            videos=count, errors_injected=handler.errors, api_errors=len(api_errors),
+                            failures=failures)
+
+
+def check_job_queue(filename):
+    """检查 JobQueue 的租约规则，返回不符合的项目说明"""
+    failures = []
+    lease_time = 0.5
+    with downloader.JobQueue(filename, 'check', node='a', lease_time=lease_time) as a, \
+            downloader.JobQueue(filename, 'check', node='b', lease_time=lease_time) as b:
+        claimed, _ = a.claim_expansion()
+        if not claimed or b.claim_expansion()[0]:
+            failures.append("展开租约应只由一个节点持有")
+        for i in range(2):
+            a.add({'url': f"u{i}", 'title': f"u{i}"}, {'position': i + 1})
+        if b.add({'url': 'u9'}, {'position': 9}):
+            failures.append("没有展开租约的节点不应能加入视频")
+        a.finish_expansion()
+
+        leased = [v['url'] for v in a.lease(1)]
+        if leased != ['u0']:
+            failures.append(f"节点 a 应领取到 u0，实际为 {leased}")
+        if [v['url'] for v in b.lease(2)] != ['u1']:
+            failures.append("节点 b 不应领取到节点 a 持有租约的视频")
+
+        # 续约期间租约不过期
+        time.sleep(lease_time * 0.6)
+        a.heartbeat()
+        time.sleep(lease_time * 0.6)
+        if 'u0' in [v['url'] for v in b.lease(2)]:
+            failures.append("续约后的租约不应过期")
+
+        # 租约过期后由其他节点领取，原节点提交的结果作废
+        time.sleep(lease_time * 1.2)
+        expired = [v['url'] for v in b.lease(1)]
+        if expired != ['u0']:
+            failures.append(f"租约过期后节点 b 应领取到 u0，实际为 {expired}")
+        if a.complete('u0', {'status': 'completed'}):
+            failures.append("租约过期的节点不应能提交结果")
+        if not b.complete('u0', {'status': 'completed'}):
+            failures.append("持有租约的节点应能提交结果")
+        b.complete('u1', {'status': 'failed', 'attempts': 1, 'error_class': 'permanent'})
+        if a.lease(2) or a.unfinished():
+            failures.append("已完成和永久失败的视频不应再被领取")
+    return failures
+
+
+def suite_distributed(args, count=10, page_size=5):
+    """检查 JobQueue 的租约规则，作为一个节点完成一个播放列表，再检查展开一直失败时能够结束
+
+    后两步分别在正常的和第二页总是出错的播放列表上运行 download_distributed；
+    结果中的计时以正常的一次为准，failures 为不符合预期的项目。
+    """
+    broken = f"/api/playlist/{count + 1}?page=1"
+    with fake_site(file_size=256 * 1024, page_size=page_size, error_rate=1.0, error_paths=(broken,)) \
+            as (base_url, handler), quiet_workdir():
+        failures = check_job_queue('check.sqlite')
+
+        written = bytes_written() or 0
+        started = time.monotonic()
+        ok = downloader.download_distributed(
+            [f"{base_url}/playlist?list={count}"], 'jobs.sqlite', format_id='progressive',
+            output_path='out', concurrency=4, poll_interval=0.2, download_subs=False, progress=None
+        )
+        elapsed = time.monotonic() - started
+        if not ok or len(os.listdir('out')) != count:
+            failures.append(f"分布式下载应完成 {count} 个视频")
+        latencies = video_latencies(handler)
+        transferred = handler.bytes_sent
+
+        # 第二页总是出错：放弃展开后应结束并返回 False，第一页的视频照常下载
+        broken_started = time.monotonic()
+        ok = downloader.download_distributed(
+            [f"{base_url}/playlist?list={count + 1}"], 'jobs.sqlite', format_id='progressive',
+            output_path='broken', concurrency=4, poll_interval=0.2, download_subs=False, progress=None
+        )
+        if ok:
+            failures.append("展开失败时应返回 False")
+        if len(os.listdir('broken')) != page_size:
+            failures.append("展开失败前已展开的视频应照常下载")
+        return suite_result(not failures, elapsed, transferred, latencies, written, videos=count,
+                            failures=failures, broken_seconds=time.monotonic() - broken_started)
+
+
+# 回归测试的场景，每个场景在单独的进程中运行，内存峰值和写入量互不影响
+SUITE = {
+    'single': suite_single,
+    'hls': suite_hls,
+    'playlist': suite_playlist,
+    'crash': suite_crash,
+    'errors': suite_errors,
+    'distributed': suite_distributed,
+}
+
+# 与基线比较的指标：1 表示越大越好，-1 表示越小越好
+REGRESSION_METRICS = {
+    'throughput': 1,
+    'latency_p50': -1,
+    'latency_p95': -1,
+    'peak_rss': -1,
+    'bytes_written': -1,
+    'bytes_transferred': -1,
+}
+
+# 延迟变化小于此值（秒）时不算退步，避免很短的延迟因为抖动误报
+LATENCY_SLACK = 0.05
+
+
+def run_suite(names, args):
+    """依次在子进程中运行回归测试场景，返回 {场景: 结果}"""
+    results = {}
+    for name in names:
+        command = [sys.executable, os.path.abspath(__file__), '--child', name,
+                   '--playlist-size', str(args.playlist_size)]
+        process = subprocess.run(command, capture_output=True, text=True)
+        lines = process.stdout.strip().splitlines()
+        if process.returncode != 0 or not lines:
+            results[name] = {'ok': False, 'error': process.stderr.strip()[-2000:]}
+        else:
+            results[name] = json.loads(lines[-1])
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """返回比基线差超过 tolerance（比例）的指标说明；运行失败的场景总是算退步"""
+    regressions = []
+    for name, result in results.items():
+        if not result.get('ok'):
+            regressions.append(f"{name}: 运行失败")
+            continue
+        expected_result = baseline.get(name)
+        if not expected_result:
+            continue
+        for metric, direction in REGRESSION_METRICS.items():
+            value, expected = result.get(metric), expected_result.get(metric)
+            if value is None or not expected:
+                continue
+            change = (value - expected) / expected
+            if metric.startswith('latency') and abs(value - expected) <= LATENCY_SLACK:
+                continue
+            if change * direction < -tolerance:
+                regressions.append(f"{name}.{metric}: {_format_metric(metric, value)}，"
+                                   f"基线 {_format_metric(metric, expected)} ({change:+.0%})")
+    return regressions
+
+
+def _format_metric(metric, value):
+    if value is None:
+        return "  不可用"
+    if metric == 'throughput':
+        return f"{value / 1024 / 1024:7.2f} MiB/s"
+    if metric.startswith('latency'):
+        return f"{value * 1000:7.1f} ms"
+    return f"{value / 1024 / 1024:7.1f} MiB"
+
+
+def print_suite_results(results):
+    for name, result in results.items():
+        if 'error' in result:
+            print(f"{name:<9} 失败\n{result['error']}")
+            continue
+        for failure in result.get('failures') or []:
+            print(f"{name:<9} 检查失败: {failure}")
+        print(f"{name:<9} 耗时 {result['elapsed']:6.2f}s  "
+              f"吞吐量 {_format_metric('throughput', result['throughput'])}  "
+              f"延迟 p50 {_format_metric('latency_p50', result['latency_p50'])} "
+              f"p95 {_format_metric('latency_p95', result['latency_p95'])} "
+              f"p99 {_format_metric('latency_p99', result['latency_p99'])}  "
+              f"内存峰值 {_format_metric('peak_rss', result['peak_rss'])}  "
+              f"写入 {_format_metric('bytes_written', result['bytes_written'])}  "
+              f"传输 {_format_metric('bytes_transferred', result['bytes_transferred'])}  "
+              f"{'成功' if result['ok'] else '失败'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="下载器性能测试")
+    parser.add_argument('--videos', type=int, default=16, help="播放列表视频数量")
+    parser.add_argument('--workers', default='1,2,4,8', help="要测试的并发数，用逗号分隔")
+    parser.add_argument('--entries', type=int, default=10000, help="状态文件测试的视频数量")
+    parser.add_argument('--fragments', default='1,2,4,8', help="要测试的分片并发数，用逗号分隔")
+    parser.add_argument('--scenario', choices=['all', 'workers', 'session', 'state', 'resume', 'fragments', 'suite'],
+                        default='all',
+                        help="要运行的测试，suite 为回归测试（不包含在 all 中）")
+    parser.add_argument('--suite', default=','.join(SUITE),
+                        help=f"回归测试要运行的场景，用逗号分隔（默认 {','.join(SUITE)}）")
+    parser.add_argument('--playlist-size', type=int, default=1000, help="回归测试中播放列表的视频数量")
+    parser.add_argument('--baseline', help="与此基线文件比较，退步超过 --tolerance 时退出码为 1")
+    parser.add_argument('--save-baseline', help="把回归测试结果保存为基线文件")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="允许比基线差的比例（默认0.25）")
+    parser.add_argument('--child', choices=list(SUITE), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # 由 run_suite 启动，只输出一行 JSON 结果
+        print(json.dumps(SUITE[args.child](args)))
+        return 0
+
+    if args.scenario == 'suite':
+        names = [name for name in args.suite.split(',') if name]
+        unknown = [name for name in names if name not in SUITE]
+        if unknown:
+            parser.error(f"未知的场景: {', '.join(unknown)}")
+        print(f"回归测试: {', '.join(names)}")
+        results = run_suite(names, args)
+        print_suite_results(results)
+        if args.save_baseline:
+            with open(args.save_baseline, 'w', encoding='utf-8') as f:
+                json.dump({'yt_dlp': downloader.yt_dlp.version.__version__, 'results': results},
+                          f, ensure_ascii=False, indent=2)
+            print(f"基线已保存到 {args.save_baseline}")
+        baseline = {}
+        if args.baseline:
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)['results']
+        regressions = find_regressions(results, baseline, args.tolerance)
+        if regressions:
+            print("\n性能退步:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        if args.baseline:
+            print(f"\n与基线 {args.baseline} 相比没有超过 {args.tolerance:.0%} 的退步")
+        return 0
+
+    if args.scenario in ('all', 'workers'):
+        worker_counts = [int(w) for w in args.workers.split(',')]
+        print(f"播放列表并发下载: {args.videos} 个视频，"
+              f"每个 {MediaHandler.file_size // 1024} KiB，"
+              f"每个连接 {MediaHandler.bandwidth // 1024} KiB/s")
+        results = bench_playlist_workers(args.videos, worker_counts)
+        baseline = results[0][2]
+        for workers, elapsed, throughput, ok in results:
+            print(f"workers={workers:<3} 耗时 {elapsed:6.2f}s  "
+                  f"吞吐量 {throughput / 1024:8.1f} KiB/s  "
+                  f"加速比 {throughput / baseline:5.2f}x  {'成功' if ok else '失败'}")
+
+    if args.scenario in ('all', 'session'):
+        print(f"\n单视频下载开销: {args.videos} 个视频")
+        for name, per_video in bench_session_reuse(args.videos).items():
+            print(f"{name}: 每个视频 {per_video * 1000:7.1f} ms")
+
+    if args.scenario in ('all', 'state'):
+        print(f"\n下载状态写入: {args.entries} 个视频")
+        for name, (written, elapsed) in bench_state_writes(args.entries).items():
+            print(f"{name}: 写入 {written / 1024 / 1024:10.1f} MiB  耗时 {elapsed:8.2f}s")
+
+    if args.scenario in ('all', 'resume'):
+        file_size = FlakyMediaHandler.file_size
+        print(f"\n断点续传: 文件 {file_size // 1024} KiB，"
+              f"每个连接 {FlakyMediaHandler.drop_after // 1024} KiB 后断开")
+        for name, (result, sent) in bench_resume().items():
+            print(f"{name}: 传输 {sent // 1024} KiB  传输量/文件大小 {sent / file_size:5.2f}  "
+                  f"{'成功' if result == 0 else '失败'}")
+
+    if args.scenario in ('all', 'fragments'):
+        handler = SegmentedMediaHandler
+        print(f"\n分片下载: 每个视频 {handler.segments} 个分片，每个 {handler.segment_size // 1024} KiB，"
+              f"每个请求延迟 {handler.latency * 1000:.0f} ms")
+        results = bench_fragments([int(n) for n in args.fragments.split(',')])
+        baseline = results[0][2]
+        for fragments, elapsed, throughput, ok in results:
+            print(f"fragments={fragments:<3} 耗时 {elapsed:6.2f}s  "
+                  f"吞吐量 {throughput / 1024:8.1f} KiB/s  "
+                  f"加速比 {throughput / baseline:5.2f}x  {'成功' if ok else '失败'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
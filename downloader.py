@@ -2,18 +2,165 @@ import os
 import sys
 import json
 import time
+import errno
+import shutil
+import zlib
+import heapq
+import re
+import random
+import socket
+import hashlib
+import sqlite3
+import argparse
+import functools
+import itertools
+import contextlib
+import collections
+import threading
+import importlib.util
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-# 尝试不同的导入方式
-try:
-    import yt_dlp
-except ImportError:
-    try:
-        from yt_dlp import YoutubeDL
-    except ImportError:
-        print("错误: 无法导入yt_dlp模块")
-        print("请确保已正确安装yt-dlp库: pip install yt-dlp")
-        print("如果问题仍然存在，请尝试: pip install --upgrade yt-dlp")
-        sys.exit(1)
+def _lazy_import(name):
+    """延迟导入模块：第一次访问模块属性时才真正执行导入，没有安装时返回 None"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# 导入 yt_dlp 需要较长时间，开始下载时才真正加载
+yt_dlp = _lazy_import('yt_dlp')
+if yt_dlp is None:
+    print("错误: 无法导入yt_dlp模块")
+    print("请确保已正确安装yt-dlp库: pip install yt-dlp")
+    print("如果问题仍然存在，请尝试: pip install --upgrade yt-dlp")
+    sys.exit(1)
+# 只有 AsyncDownloader 用到 asyncio，同样延迟加载
+asyncio = _lazy_import('asyncio')
+
+# yt-dlp 的错误和警告中出现这些内容时认为被YouTube限制
+THROTTLE_MARKERS = (
+    'HTTP Error 429',
+    'Too Many Requests',
+    'HTTP Error 403',
+    "confirm you're not a bot",
+    'confirm you’re not a bot',
+)
+
+# 下载中断后用相同格式从断点继续的次数
+RESUME_ATTEMPTS = 3
+
+# 分布式模式下一个节点展开播放列表连续失败多少次后放弃展开
+EXPAND_ATTEMPTS = 3
+
+# 出现这些内容的错误重试也不会成功（私有、已删除、地区限制等）
+PERMANENT_MARKERS = (
+    'Private video',
+    'Video unavailable',
+    'This video is unavailable',
+    'This video has been removed',
+    'This video is no longer available',
+    'account associated with this video has been terminated',
+    'not available in your country',
+    'blocked it in your country',
+    'Sign in to confirm your age',
+    'members-only',
+    'Join this channel',
+    'HTTP Error 404',
+    'HTTP Error 410',
+    'Unsupported URL',
+    'is not a valid URL',
+)
+
+# 请求的格式不存在，换用 best 格式可能成功
+FORMAT_MARKERS = (
+    'Requested format is not available',
+)
+
+# 磁盘空间不足，重试前需要先腾出空间
+DISK_MARKERS = (
+    'No space left on device',
+    '磁盘空间不足',
+)
+
+# 每类错误在 download_video 中最多重试的次数，永久错误不重试，
+# 下载列表时记录为 'permanent' 的视频也不再尝试
+RETRY_BUDGETS = {
+    'permanent': 0,
+    'disk': 0,
+    'format': 1,
+    'throttle': 2,
+    'transient': RESUME_ATTEMPTS,
+}
+
+# 为 True 时打印调试信息，可用环境变量 YTDL_DEBUG=1 或批量模式的 --debug 打开
+DEBUG = os.environ.get('YTDL_DEBUG', '') not in ('', '0')
+
+# 单个视频下载时进度显示的最短刷新间隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+# 预设格式，交互模式的预设菜单和批量模式的 --preset 共用
+PRESET_FORMATS = {
+    'best': "bestvideo+bestaudio/best",
+    'audio': "bestaudio/best",
+    '720p': "bestvideo[height<=720]+bestaudio/best[height<=720]/best",
+    'low': "worstvideo+worstaudio/worst",
+    # 根据实测下载速度选择，见 choose_auto_format
+    'auto': "auto",
+}
+
+# 分片格式（DASH/HLS）每个视频同时下载的分片数
+FRAGMENT_CONCURRENCY = 4
+
+# 所有下载同时打开的连接数上限（视频数 × 每个视频的分片数）
+MAX_CONNECTIONS = 16
+
+# 自动选择格式时每个视频允许的下载时间（秒）
+AUTO_TIME_BUDGET = 600
+
+# 下载时在磁盘上额外保留的空间（字节），默认不保留，批量模式可以用 --min-free 指定
+DISK_RESERVE = 0
+
+# 默认下载的字幕语言
+DEFAULT_SUB_LANGS = ['en', 'zh-Hans', 'zh-CN']
+
+# 字幕格式的优先级，这些格式ffmpeg可以直接嵌入；都没有时使用最后一个（yt-dlp 的 best）
+SUBTITLE_EXTS = ('vtt', 'srt', 'ass')
+
+def classify_error(error):
+    """把异常或 yt-dlp 的错误信息归为 RETRY_BUDGETS 中的一类"""
+    message = str(error or '')
+    if any(marker in message for marker in THROTTLE_MARKERS):
+        return 'throttle'
+    if any(marker in message for marker in FORMAT_MARKERS):
+        return 'format'
+    if any(marker in message for marker in DISK_MARKERS) or getattr(error, 'errno', None) == errno.ENOSPC:
+        return 'disk'
+    if any(marker in message for marker in PERMANENT_MARKERS):
+        return 'permanent'
+    if isinstance(error, (yt_dlp.utils.GeoRestrictedError, yt_dlp.utils.UnsupportedError)):
+        return 'permanent'
+    return 'transient'
+
+def retry_delay(n, base=0.5, cap=30.0):
+    """第 n 次重试（从0开始）前等待的秒数：指数增长并加入随机抖动
+
+    使用完全随机的等待时间，避免多个线程同时失败后又在同一时刻一起重试。
+    也作为 yt-dlp 的 retry_sleep_functions 使用。
+    """
+    return random.uniform(0, min(cap, base * 2 ** n))
+
+def _debug(message):
+    """DEBUG 为 True 时打印调试信息"""
+    if DEBUG:
+        print(f"调试: {message}")
 
 def print_banner():
     """打印程序横幅"""
@@ -23,153 +170,1830 @@ def print_banner():
     print("该程序可以从YouTube下载视频到您的本地计算机")
     print("=" * 80)
 
-def get_available_formats(url):
-    """获取可用的格式列表"""
-    ydl_opts = {
-        'quiet': True,
-        'no_warnings': True,
-    }
-    
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        info = ydl.extract_info(url, download=False)
-        
-        # 调试: 打印全部格式数量
-        print(f"调试: 发现 {len(info.get('formats', []))} 个格式")
-        
-        # 收集视频格式
-        formats = []
-        for f in info.get('formats', []):
-            # 调试: 打印格式信息
-            print(f"调试: 检查格式 {f.get('format_id')} - vcodec:{f.get('vcodec')}, acodec:{f.get('acodec')}")
-            
-            # 只选择带有视频的格式
-            if f.get('vcodec') != 'none' and f.get('acodec') != 'none':
-                format_str = f"{f['format_id']} - {f.get('resolution', 'N/A')} - {f.get('ext', 'N/A')}"
-                formats.append((f['format_id'], format_str))
-        
-        # 收集仅音频格式
-        audio_formats = []
-        for f in info.get('formats', []):
-            if f.get('vcodec') == 'none' and f.get('acodec') != 'none':
-                format_str = f"{f['format_id']} - 仅音频 - {f.get('ext', 'N/A')}"
-                audio_formats.append((f['format_id'], format_str))
-        
-        # 调试: 打印收集结果
-        print(f"调试: 找到 {len(formats)} 个视频+音频格式")
-        print(f"调试: 找到 {len(audio_formats)} 个仅音频格式")
-        
-        # 如果没有找到视频+音频格式，尝试收集任何包含视频的格式
-        if len(formats) == 0:
-            print("调试: 未找到同时包含视频和音频的格式，尝试收集任何包含视频的格式...")
-            for f in info.get('formats', []):
-                if f.get('vcodec') != 'none':  # 只要有视频轨道
-                    format_str = f"{f['format_id']} - {f.get('resolution', 'N/A')} - {f.get('ext', 'N/A')} - {'无音频' if f.get('acodec') == 'none' else '有音频'}"
-                    formats.append((f['format_id'], format_str))
-            print(f"调试: 现在找到 {len(formats)} 个包含视频的格式")
-        
+# 每个主机第一次匹配到的提取器。逐个尝试所有提取器的正则表达式每个链接要几十毫秒，
+# 同一主机的其他链接先试这个提取器；通用提取器匹配的主机直接使用URL作为键
+_host_extractors = {}
+
+def _match_extractor(url):
+    """返回能识别 url 的提取器类，只有通用提取器能处理时返回 None"""
+    host = urllib.parse.urlsplit(url).netloc.lower()
+    ie = _host_extractors.get(host)
+    if ie is not None and (ie.ie_key() == 'Generic' or ie.suitable(url)):
+        return None if ie.ie_key() == 'Generic' else ie
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.suitable(url):
+            _host_extractors.setdefault(host, ie)
+            return None if ie.ie_key() == 'Generic' else ie
+    return None
+
+def _cache_key(kind, url):
+    """生成缓存键：能识别的链接使用提取器和视频/播放列表ID，否则使用URL本身"""
+    ie = _match_extractor(url)
+    temp_id = ie.get_temp_id(url) if ie is not None else None
+    if temp_id:
+        return f"{kind}:{ie.ie_key()}:{temp_id}"
+    return f"{kind}:url:{url}"
+
+class MetadataCache:
+    """extract_info 结果的本地缓存（SQLite，压缩后的JSON）
+
+    每条记录按视频或播放列表ID保存，读取时由调用方给出可接受的最大年龄：
+    标题和播放列表条目可以长期有效（ttl），而格式中的下载地址很快就会过期
+    （format_ttl）。超过 max_entries 条或 max_bytes 字节时，按最近访问时间
+    淘汰最久未使用的记录。hits、misses、stale 和 evictions 计数可通过 stats() 查看。
+    """
+
+    def __init__(self, filename="metadata_cache.sqlite", ttl=7 * 24 * 3600, format_ttl=5 * 3600,
+                 max_entries=10000, max_bytes=200 * 1024 * 1024):
+        self.filename = filename
+        self.ttl = ttl
+        self.format_ttl = format_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def age(self, kind, url):
+        """返回缓存记录的年龄（秒），没有记录时返回 None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT created FROM entries WHERE key = ?", (_cache_key(kind, url),)
+            ).fetchone()
+        return None if row is None else time.time() - row[0]
+
+    def get(self, kind, url, max_age=None):
+        """读取缓存的信息；没有记录或超过 max_age（默认 ttl）时返回 None"""
+        if max_age is None:
+            max_age = self.ttl
+        key = _cache_key(kind, url)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data, created FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            if now - row[1] > max_age:
+                self.stale += 1
+                return None
+            self.hits += 1
+            self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, kind, url, info):
+        """保存提取到的信息，必要时淘汰最久未使用的记录"""
+        data = zlib.compress(json.dumps(
+            yt_dlp.YoutubeDL.sanitize_info(info), ensure_ascii=False
+        ).encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, data, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (_cache_key(kind, url), data, len(data), now, now)
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        count, total = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        victims = []
+        for key, size in self._db.execute("SELECT key, size FROM entries ORDER BY accessed"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            victims.append((key,))
+            count -= 1
+            total -= size
+        self._db.executemany("DELETE FROM entries WHERE key = ?", victims)
+        self.evictions += len(victims)
+
+    def stats(self):
+        """返回命中、未命中、过期和淘汰计数以及当前缓存大小"""
+        with self._lock:
+            count, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
         return {
-            'title': info.get('title', 'Unknown Title'),
-            'id': info.get('id', ''),
-            'video_formats': formats,
-            'audio_formats': audio_formats
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'evictions': self.evictions,
+            'entries': count,
+            'bytes': total
         }
 
-def download_video(url, format_id=None, output_path=None, download_subs=True, sub_langs=None):
-    """下载视频"""
-    # 设置输出路径
+class DownloadIndex:
+    """已完成下载的索引（SQLite），按视频和格式找到已经下载过的文件
+
+    键为 _cache_key('download', url) 加格式字符串，查询只走主键，
+    几十万条记录时查询时间也基本不变。hash_files 为 True 时同时记录文件的
+    SHA-256：内容与已有文件相同的新文件会被替换为指向已有文件的硬链接。
+    """
+
+    def __init__(self, filename="download_index.sqlite", hash_files=False):
+        self.filename = filename
+        self.hash_files = hash_files
+        self.reused = 0
+        self.linked = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "key TEXT PRIMARY KEY, filepath TEXT NOT NULL, size INTEGER NOT NULL, "
+            "sha256 TEXT, created REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @staticmethod
+    def _key(url, format_id):
+        return f"{_cache_key('download', url)}:{format_id}"
+
+    def lookup(self, url, format_id):
+        """返回已下载的文件路径；没有记录或文件已被删除、修改时返回 None"""
+        key = self._key(url, format_id)
+        with self._lock:
+            row = self._db.execute("SELECT filepath, size FROM files WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            filepath, size = row
+            try:
+                if os.path.getsize(filepath) == size:
+                    return filepath
+            except OSError:
+                pass
+            # 文件已经不在了，删除失效的记录
+            self._db.execute("DELETE FROM files WHERE key = ?", (key,))
+            self._db.commit()
+        return None
+
+    def link(self, existing, output_path=None):
+        """让已有文件出现在 output_path 中
+
+        优先创建硬链接；同名文件已存在或无法创建硬链接（例如跨文件系统）时
+        直接引用已有文件。返回之后应记录的文件路径。
+        """
+        self.reused += 1
+        target = os.path.join(output_path or '.', os.path.basename(existing))
+        if os.path.exists(target):
+            return target if os.path.samefile(existing, target) else existing
+        try:
+            if output_path and not os.path.exists(output_path):
+                os.makedirs(output_path)
+            os.link(existing, target)
+        except OSError:
+            return existing
+        return target
+
+    def add(self, url, format_id, filepath):
+        """记录下载完成的文件"""
+        if not filepath or not os.path.exists(filepath):
+            return
+        sha256 = _file_sha256(filepath) if self.hash_files else None
+        with self._lock:
+            if sha256 is not None:
+                row = self._db.execute(
+                    "SELECT filepath FROM files WHERE sha256 = ? AND filepath != ? LIMIT 1",
+                    (sha256, filepath)
+                ).fetchone()
+                if row is not None and self._replace_with_link(row[0], filepath):
+                    self.linked += 1
+            self._db.execute(
+                "INSERT OR REPLACE INTO files (key, filepath, size, sha256, created) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (self._key(url, format_id), filepath, os.path.getsize(filepath), sha256, time.time())
+            )
+            self._db.commit()
+
+    @staticmethod
+    def _replace_with_link(existing, filepath):
+        """把 filepath 替换为指向内容相同的 existing 的硬链接"""
+        try:
+            if not os.path.exists(existing) or os.path.samefile(existing, filepath):
+                return False
+            tmp_filename = filepath + '.link'
+            os.link(existing, tmp_filename)
+            os.replace(tmp_filename, filepath)
+            return True
+        except OSError:
+            return False
+
+    def stats(self):
+        """返回记录数、本次复用的文件数和合并为硬链接的文件数"""
+        with self._lock:
+            count = self._db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        return {'entries': count, 'reused': self.reused, 'linked': self.linked}
+
+def _file_sha256(filepath, chunk_size=1024 * 1024):
+    """计算文件的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class SubtitleCache:
+    """按视频ID、语言、类型（人工/自动）和格式缓存的字幕（SQLite，压缩保存）
+
+    自动字幕可能会更新，超过 ttl 的记录视为不存在。
+    """
+
+    def __init__(self, filename="subtitle_cache.sqlite", ttl=30 * 24 * 3600):
+        self.filename = filename
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS subtitles ("
+            "video_id TEXT NOT NULL, lang TEXT NOT NULL, kind TEXT NOT NULL, ext TEXT NOT NULL, "
+            "data BLOB NOT NULL, fetched REAL NOT NULL, PRIMARY KEY (video_id, lang, kind, ext))"
+        )
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def get(self, video_id, lang, kind, ext):
+        """读取缓存的字幕内容（bytes），没有或已过期时返回 None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data, fetched FROM subtitles WHERE video_id = ? AND lang = ? AND kind = ? AND ext = ?",
+                (video_id, lang, kind, ext)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return zlib.decompress(row[0])
+
+    def put(self, video_id, lang, kind, ext, data):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO subtitles (video_id, lang, kind, ext, data, fetched) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (video_id, lang, kind, ext, zlib.compress(data), time.time())
+            )
+            self._db.commit()
+
+# 视频和音频编码的优先级，数值越大越好，未列出的编码为 0
+VIDEO_CODEC_RANK = {'av01': 4, 'vp09': 3, 'vp9': 3, 'hev1': 2, 'hvc1': 2, 'avc1': 1}
+AUDIO_CODEC_RANK = {'opus': 3, 'mp4a': 2, 'vorbis': 1}
+
+# 单个格式的精简记录，只保留排序和显示需要的字段
+FormatRecord = collections.namedtuple(
+    'FormatRecord', 'format_id height fps tbr vcodec acodec filesize ext resolution'
+)
+
+def _format_sort_key(record):
+    return (record.height, record.fps, record.tbr,
+            VIDEO_CODEC_RANK.get(record.vcodec, 0), AUDIO_CODEC_RANK.get(record.acodec, 0),
+            record.filesize)
+
+def rank_formats(formats):
+    """遍历一次格式列表，分为视频+音频、仅视频和仅音频三类，每类按质量从高到低排序
+
+    排序依次比较分辨率、帧率、码率、编码和文件大小。
+    返回 {'video_audio': [...], 'video': [...], 'audio': [...]}，元素为 FormatRecord。
+    """
+    ranked = {'video_audio': [], 'video': [], 'audio': []}
+    for f in formats:
+        vcodec = f.get('vcodec')
+        acodec = f.get('acodec')
+        has_video = vcodec != 'none'
+        has_audio = acodec != 'none'
+        if has_video and has_audio:
+            kind = 'video_audio'
+        elif has_video:
+            kind = 'video'
+        elif has_audio:
+            kind = 'audio'
+        else:
+            # 故事板等既没有视频也没有音频的格式
+            continue
+        ranked[kind].append(FormatRecord(
+            f['format_id'], f.get('height') or 0, f.get('fps') or 0, f.get('tbr') or 0,
+            _codec_name(vcodec) if has_video else None, _codec_name(acodec) if has_audio else None,
+            f.get('filesize') or f.get('filesize_approx') or 0, f.get('ext', 'N/A'),
+            f.get('resolution', 'N/A')
+        ))
+    for records in ranked.values():
+        records.sort(key=_format_sort_key, reverse=True)
+    return ranked
+
+def _format_label(record):
+    """生成显示在菜单中的格式说明"""
+    if record.vcodec is None:
+        return f"{record.format_id} - 仅音频 - {record.ext}"
+    return f"{record.format_id} - {record.resolution} - {record.ext}"
+
+def _estimated_size(record, duration):
+    """估计格式的文件大小：优先使用 filesize，否则按码率和时长估算，无法估计时返回 None"""
+    if record.filesize:
+        return record.filesize
+    if record.tbr and duration:
+        return record.tbr * 1000 / 8 * duration
+    return None
+
+def select_auto(ranked, duration, throughput, time_budget=AUTO_TIME_BUDGET):
+    """选择预计在 time_budget 秒内能下载完的最佳格式
+
+    throughput 为每个下载的速度（字节/秒）。视频按质量从高到低尝试，与最佳音频
+    组合；都放不下时使用最低质量的组合。无法估计大小时返回 None。
+    """
+    budget = throughput * time_budget
+    audio = [(r, _estimated_size(r, duration)) for r in ranked['audio']]
+    audio = [(r, size) for r, size in audio if size is not None]
+    
+    candidates = []
+    for r in ranked['video']:
+        size = _estimated_size(r, duration)
+        if size is None:
+            continue
+        for a, audio_size in audio:
+            # 音频从高到低，取放得下的最好的一个
+            if size + audio_size <= budget:
+                candidates.append((r, f"{r.format_id}+{a.format_id}"))
+                break
+    for r in ranked['video_audio']:
+        size = _estimated_size(r, duration)
+        if size is not None and size <= budget:
+            candidates.append((r, r.format_id))
+    if candidates:
+        return max(candidates, key=lambda c: _format_sort_key(c[0]))[1]
+    
+    if not ranked['video'] and not ranked['video_audio'] and audio:
+        # 只有音频时选放得下的最好的音频
+        fitting = [r for r, size in audio if size <= budget]
+        return (fitting or [audio[-1][0]])[0].format_id
+    # 什么都放不下时使用最小的组合
+    if ranked['video'] and audio:
+        return f"{ranked['video'][-1].format_id}+{audio[-1][0].format_id}"
+    if ranked['video_audio']:
+        return ranked['video_audio'][-1].format_id
+    return None
+
+class ThroughputEstimator:
+    """根据最近的下载估计单个下载的速度（字节/秒）
+
+    每个下载完成后用指数加权平均更新，alpha 为新样本的权重。
+    小于 min_bytes 的文件主要受延迟影响，不作为样本。
+    """
+
+    def __init__(self, alpha=0.3, min_bytes=256 * 1024):
+        self.alpha = alpha
+        self.min_bytes = min_bytes
+        self.estimate = None
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes, seconds):
+        if nbytes < self.min_bytes or not seconds or seconds <= 0:
+            return
+        speed = nbytes / seconds
+        with self._lock:
+            if self.estimate is None:
+                self.estimate = speed
+            else:
+                self.estimate = self.alpha * speed + (1 - self.alpha) * self.estimate
+            self.samples += 1
+
+def _probe_throughput(session, info, ranked, probe_bytes=1024 * 1024):
+    """下载一个格式的前 probe_bytes 字节来测量速度，不能直接请求时返回 None"""
+    formats = {f.get('format_id'): f for f in info.get('formats') or []}
+    # 优先使用最大的音频格式，通常是可以直接请求的单个文件
+    for record in ranked['audio'] + ranked['video_audio'] + ranked['video']:
+        fmt = formats.get(record.format_id) or {}
+        if fmt.get('url') and yt_dlp.utils.determine_protocol(fmt) in ('http', 'https'):
+            break
+    else:
+        return None
+    try:
+        request = yt_dlp.networking.Request(
+            fmt['url'], headers=dict(fmt.get('http_headers') or {}, Range=f"bytes=0-{probe_bytes - 1}")
+        )
+        with session.ydl.urlopen(request) as response:
+            # 从收到响应头开始计时，不计入连接建立的延迟
+            started = time.monotonic()
+            nbytes = len(response.read(probe_bytes))
+            elapsed = time.monotonic() - started
+    except Exception as e:
+        _debug(f"测速失败: {e}")
+        return None
+    if nbytes < probe_bytes // 4 or elapsed <= 0:
+        return None
+    return nbytes / elapsed
+
+def choose_auto_format(session, info, time_budget=AUTO_TIME_BUDGET):
+    """为 'auto' 预设选择具体格式
+
+    下载速度来自会话最近的下载记录，还没有记录时先下载所选格式的开头测速。
+    无法测速或估计大小时退回 720p 预设。
+    """
+    ranked = rank_formats(info.get('formats') or [])
+    throughput = session.throughput.estimate
+    if throughput is None:
+        throughput = _probe_throughput(session, info, ranked)
+        if throughput is None:
+            print("无法测量下载速度，使用平衡质量(720p)")
+            return PRESET_FORMATS['720p']
+    format_id = select_auto(ranked, info.get('duration'), throughput, time_budget)
+    if format_id is None:
+        print("无法估计格式大小，使用平衡质量(720p)")
+        return PRESET_FORMATS['720p']
+    print(f"自动选择格式: {format_id} (下载速度约 {throughput / 1024 / 1024:.2f} MiB/s，"
+          f"每个视频 {time_budget} 秒)")
+    return format_id
+
+def estimate_footprint(selected, duration=None):
+    """估计下载选中的格式时磁盘占用的峰值（字节），无法估计时返回 0
+
+    selected 为 DownloadSession.select_formats 的结果。大小取 filesize 或
+    filesize_approx，都没有时按码率和时长估算。分别下载视频和音频再合并，
+    或者需要转换容器时，原始文件和输出文件会同时存在，峰值按两倍计算。
+    """
+    if not selected:
+        return 0
+    parts = selected[0].get('requested_formats') or selected[:1]
+    total = 0
+    for f in parts:
+        size = f.get('filesize') or f.get('filesize_approx')
+        if not size and f.get('tbr') and duration:
+            size = f['tbr'] * 1000 / 8 * duration
+        total += size or 0
+    if len(parts) == 1 and parts[0].get('ext') in ('mp4', 'm4a'):
+        return int(total)
+    return int(total * 2)
+
+class DiskSpaceBudget:
+    """按磁盘剩余空间决定何时开始下一个下载，所有下载线程共用
+
+    每个下载开始前用 acquire 预留预计的峰值占用（见 estimate_footprint）。
+    剩余空间减去已预留的空间和 reserve 字节后仍然足够时才开始，否则等待
+    其他下载完成后释放空间。没有其他下载在进行时仍然放不下的视频直接失败
+    （errno 为 ENOSPC），不会一直等待。正在下载的文件已经占用的空间也计入
+    预留，因此估计是保守的。stop_event 被设置后放弃等待并抛出 DownloadCancelled。
+    paths 可以是多个目录（例如临时目录和下载路径在不同的文件系统上），
+    按剩余空间最少的一个计算。
+    """
+
+    def __init__(self, paths='.', reserve=DISK_RESERVE, stop_event=None, poll_interval=1.0):
+        self.paths = [paths] if isinstance(paths, (str, os.PathLike)) else list(paths)
+        self.reserve = reserve
+        self.stop_event = stop_event
+        self.poll_interval = poll_interval
+        self.reserved = 0
+        self.active = 0
+        self.waits = 0
+        self._cond = threading.Condition()
+        for path in self.paths:
+            os.makedirs(path, exist_ok=True)
+
+    @property
+    def path(self):
+        """剩余空间最少的目录"""
+        return min(self.paths, key=lambda path: shutil.disk_usage(path).free)
+
+    def available(self):
+        """剩余空间减去已预留的空间和 reserve"""
+        free = min(shutil.disk_usage(path).free for path in self.paths)
+        return free - self.reserved - self.reserve
+
+    def acquire(self, nbytes):
+        waited = False
+        with self._cond:
+            while nbytes > self.available():
+                if self.active == 0:
+                    raise OSError(errno.ENOSPC, f"磁盘空间不足: 需要约 {nbytes / 1024 / 1024:.0f} MiB，"
+                                                f"{self.path} 只剩 {max(0, self.available()) / 1024 / 1024:.0f} MiB")
+                if self.stop_event is not None and self.stop_event.is_set():
+                    raise yt_dlp.utils.DownloadCancelled("用户中断下载")
+                if not waited:
+                    waited = True
+                    self.waits += 1
+                    print(f"\n磁盘空间不足，等待其他下载完成 (需要约 {nbytes / 1024 / 1024:.0f} MiB)")
+                self._cond.wait(self.poll_interval)
+            self.reserved += nbytes
+            self.active += 1
+
+    def release(self, nbytes):
+        with self._cond:
+            self.reserved -= nbytes
+            self.active -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def reserve_space(self, nbytes):
+        """在 with 块期间预留 nbytes 字节"""
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+def make_disk_budget(output_path=None, scratch_path=None, min_free=DISK_RESERVE, stop_event=None):
+    """为一批下载创建 DiskSpaceBudget
+
+    按 output_path 所在的磁盘计算。scratch_path 与 output_path 不在同一文件系统上时
+    两个磁盘都要放得下（下载中的文件在 scratch_path，完成后复制到 output_path），
+    并打印警告。每个磁盘在下载后至少保留 min_free 字节的空闲空间。
+    """
+    output_path = output_path or '.'
+    paths = [output_path]
+    if scratch_path:
+        os.makedirs(scratch_path, exist_ok=True)
+        os.makedirs(output_path, exist_ok=True)
+        if os.stat(scratch_path).st_dev != os.stat(output_path).st_dev:
+            print(f"警告: 临时目录 {scratch_path} 与下载路径 {output_path} 不在同一文件系统上，"
+                  f"完成的文件需要复制而不是重命名")
+            paths.append(scratch_path)
+    return DiskSpaceBudget(paths, min_free, stop_event)
+
+def get_available_formats(url, session=None, cache=None):
+    """获取可用的格式列表
+
+    传入 cache 时优先使用未超过 format_ttl 的缓存信息。格式由 rank_formats
+    按质量从高到低排序。
+    """
+    info = cache.get('video', url, cache.format_ttl) if cache else None
+    if info is None:
+        if session is None:
+            with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl, metrics.timer('extract'):
+                info = ydl.extract_info(url, download=False)
+        else:
+            info = session.extract_info(url, quiet=True, no_warnings=True, ignoreerrors=False)
+        if cache:
+            cache.put('video', url, info)
+    
+    ranked = rank_formats(info.get('formats') or [])
+    _debug(f"发现 {len(info.get('formats') or [])} 个格式: "
+           f"视频+音频 {len(ranked['video_audio'])}, 仅视频 {len(ranked['video'])}, "
+           f"仅音频 {len(ranked['audio'])}")
+    
+    # 收集视频格式，没有同时包含视频和音频的格式时使用任何包含视频的格式
+    if ranked['video_audio']:
+        formats = [(r.format_id, _format_label(r)) for r in ranked['video_audio']]
+    else:
+        formats = [(r.format_id, f"{_format_label(r)} - 无音频") for r in ranked['video']]
+    
+    # 收集仅音频格式
+    audio_formats = [(r.format_id, _format_label(r)) for r in ranked['audio']]
+    
+    return {
+        'title': info.get('title', 'Unknown Title'),
+        'id': info.get('id', ''),
+        'video_formats': formats,
+        'audio_formats': audio_formats,
+        'info': info  # 完整的视频信息，下载时直接使用，避免重复提取
+    }
+
+def _output_template(output_path):
+    """根据输出路径生成文件名模板
+
+    文件名带有视频ID，标题相同的不同视频不会互相覆盖。
+    """
     if output_path:
         if not os.path.exists(output_path):
             os.makedirs(output_path)
-        output_template = os.path.join(output_path, '%(title)s.%(ext)s')
-    else:
-        output_template = '%(title)s.%(ext)s'
-    
-    # 配置下载选项
-    ydl_opts = {
-        'outtmpl': output_template,
-        'progress_hooks': [progress_hook],
+        return os.path.join(output_path, '%(title)s [%(id)s].%(ext)s')
+    return '%(title)s [%(id)s].%(ext)s'
+
+def build_download_options(progress_hooks=None, fragments=FRAGMENT_CONCURRENCY):
+    """生成一批下载共用的 yt-dlp 选项（不含格式和输出路径）
+
+    字幕不由 yt-dlp 在视频之前逐个下载，而是由 SubtitleStage 与视频并行获取。
+    """
+    return {
+        'progress_hooks': progress_hooks or [progress_hook],
         'ignoreerrors': True,  # 忽略错误，继续下载
         'nooverwrites': False,  # 覆盖已存在的文件
         'retries': 10,          # 重试次数
         'fragment_retries': 10, # 片段重试次数
+        # 重试前等待一段带随机抖动的时间，而不是立即重试
+        'retry_sleep_functions': {'http': retry_delay, 'fragment': retry_delay,
+                                  'extractor': retry_delay},
+        'continuedl': True,     # 从 .part 文件和 .ytdl 片段记录继续未完成的下载
+        'concurrent_fragment_downloads': fragments,  # 同时下载的分片数
     }
 
-    # 添加字幕下载选项
-    if download_subs:
-        # 如果没有指定语言，默认下载英文和中文字幕
-        if not sub_langs:
-            sub_langs = ['en', 'zh-Hans', 'zh-CN']
-        
-        print(f"将下载字幕: {', '.join(sub_langs)}")
-        ydl_opts.update({
-            'writesubtitles': True,        # 下载字幕
-            'writeautomaticsub': True,     # 下载自动生成的字幕
-            'subtitleslangs': sub_langs,   # 字幕语言
-            # 'subtitlesformat': 'srt',      # 字幕格式
-            'subtitlesformat': 'best',      # 字幕格式
-            'embedsubtitles': True,        # 嵌入字幕到视频
-        })
+# 各容器可以直接容纳（无需重新编码）的编码，编码名只取第一个点之前的部分
+CONTAINER_CODECS = {
+    'mp4': (
+        {'avc1', 'avc3', 'h264', 'hev1', 'hvc1', 'h265', 'hevc', 'av01', 'vp09', 'vp9', 'mp4v'},
+        {'mp4a', 'aac', 'mp3', 'opus', 'ac-3', 'ec-3', 'flac', 'alac'},
+    ),
+    # 仅音频的容器
+    'm4a': (set(), {'mp4a', 'aac', 'alac'}),
+    'opus': (set(), {'opus'}),
+    'ogg': (set(), {'vorbis', 'opus', 'flac'}),
+    'mp3': (set(), {'mp3'}),
+    'flac': (set(), {'flac'}),
+}
 
-    # 如果指定了格式，则使用该格式
-    if format_id:
-        ydl_opts['format'] = format_id
-    else:
-        # 如果没有指定格式，使用最佳格式
-        print("未指定格式，将使用最佳视频+音频格式")
-        ydl_opts['format'] = 'bestvideo+bestaudio/best'
+# 仅音频下载时按顺序选择第一个能直接容纳音频编码的容器
+AUDIO_CONTAINERS = ('m4a', 'opus', 'ogg', 'mp3', 'flac')
+
+def audio_container(info):
+    """返回能直接容纳该音频编码的容器扩展名，编码未知时返回 None"""
+    acodec = _codec_name(info.get('acodec'))
+    for ext in AUDIO_CONTAINERS:
+        if acodec in CONTAINER_CODECS[ext][1]:
+            return ext
+    return None
+
+def is_audio_only(format_id, info=None):
+    """格式是否只下载音频：bestaudio 这类选择器，或 info 中只有音频的具体格式"""
+    first = (format_id or '').split('/')[0]
+    if '+' in first:
+        return False
+    if first.startswith(('bestaudio', 'worstaudio', 'ba', 'wa')):
+        return True
+    for f in (info or {}).get('formats') or []:
+        if f.get('format_id') == first:
+            return f.get('vcodec') == 'none'
+    return False
+
+def _codec_name(codec):
+    """把 'avc1.64001F' 这样的编码字符串归一化为 'avc1'"""
+    if not codec:
+        return None
+    return codec.split('.')[0].lower()
+
+def plan_postprocessing(info, target_ext='mp4'):
+    """决定如何把下载结果放进目标容器
+
+    返回 (动作, 原因)，动作为 'skip'（已经是目标格式）、'remux'（只复制流）
+    或 'transcode'（需要重新编码）。
+    """
+    source_ext = (info.get('ext') or '').lower()
+    if source_ext == target_ext:
+        return 'skip', f"已经是 {target_ext} 格式"
     
+    video_codecs, audio_codecs = CONTAINER_CODECS[target_ext]
+    vcodec = _codec_name(info.get('vcodec'))
+    acodec = _codec_name(info.get('acodec'))
+    if vcodec is None and acodec is None:
+        return 'transcode', "无法确定编码"
+    if vcodec not in (None, 'none') and vcodec not in video_codecs:
+        return 'transcode', f"{target_ext} 不支持视频编码 {vcodec}"
+    if acodec not in (None, 'none') and acodec not in audio_codecs:
+        return 'transcode', f"{target_ext} 不支持音频编码 {acodec}"
+    return 'remux', f"{vcodec}/{acodec} 可以直接放入 {target_ext}"
+
+# 指标名称、类型和说明
+METRIC_TYPES = {
+    'ytdl_stage_seconds': ('summary', "各阶段耗时（秒）"),
+    'ytdl_downloaded_bytes_total': ('counter', "下载的字节数"),
+    'ytdl_videos_total': ('counter', "处理完成的视频数，按结果分类"),
+    'ytdl_retries_total': ('counter', "重试次数，按类型分类"),
+    'ytdl_fallbacks_total': ('counter', "改用 best 格式下载的次数"),
+    'ytdl_failures_total': ('counter', "失败次数，按阶段和错误类别（见 classify_error）分类"),
+    'ytdl_throttle_backoffs_total': ('counter', "因限制信号退避的次数"),
+    'ytdl_lease_expired_total': ('counter', "租约过期后重新领取的视频数（分布式模式）"),
+}
+
+# 后期处理步骤（yt-dlp 的 pp_key）对应的阶段名，未列出的步骤不单独计时
+POSTPROCESS_STAGES = {
+    'FFmpegMerger': 'merge',
+    'RemuxOrConvert': 'convert',
+    'MoveFiles': 'move',
+}
+
+class Metrics:
+    """线程安全的计数器和计时器，可导出为 Prometheus 文本格式
+
+    计时器按阶段记录耗时总和与次数（summary），计数器按标签分别累加。
+    render() 生成文本格式，另外计算下载阶段的平均速度
+    ytdl_download_bytes_per_second。
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """计数器加 value"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """记录一次观测值（累加总和与次数）"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            total, count = self._values.get((name, key), (0.0, 0))
+            self._values[(name, key)] = (total + value, count + 1)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """统计 with 块的耗时"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe('ytdl_stage_seconds', time.monotonic() - started, stage=stage)
+
+    def value(self, name, **labels):
+        """返回计数器的当前值，计时器返回 (总和, 次数)"""
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))))
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+            self.started = time.time()
+
+    def render(self):
+        """生成 Prometheus 文本格式"""
+        with self._lock:
+            values = dict(self._values)
+        
+        def format_labels(labels):
+            if not labels:
+                return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                       for _, v in labels)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+        
+        lines = []
+        for name, (kind, help_text) in METRIC_TYPES.items():
+            samples = sorted((labels, v) for (n, labels), v in values.items() if n == name)
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, v in samples:
+                if kind == 'summary':
+                    lines.append(f"{name}_sum{format_labels(labels)} {v[0]:.6f}")
+                    lines.append(f"{name}_count{format_labels(labels)} {v[1]}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {v}")
+        
+        downloaded = values.get(('ytdl_downloaded_bytes_total', ()), 0)
+        seconds = values.get(('ytdl_stage_seconds', (('stage', 'download'),)), (0.0, 0))[0]
+        lines.append("# HELP ytdl_download_bytes_per_second 下载阶段的平均速度")
+        lines.append("# TYPE ytdl_download_bytes_per_second gauge")
+        lines.append(f"ytdl_download_bytes_per_second {downloaded / seconds if seconds else 0:.1f}")
+        lines.append("# HELP ytdl_start_time_seconds 开始统计的时间")
+        lines.append("# TYPE ytdl_start_time_seconds gauge")
+        lines.append(f"ytdl_start_time_seconds {self.started:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename):
+        """把指标写入文件（先写临时文件再替换，读取方不会看到写了一半的文件）"""
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+        os.replace(tmp_filename, filename)
+
+# 全局指标，下载的各个阶段都记录到这里
+metrics = Metrics()
+
+class MetricsExporter:
+    """导出 metrics：每 interval 秒写一次文件，和/或在 port 上提供 /metrics"""
+
+    def __init__(self, filename=None, port=None, interval=15, registry=None):
+        self.filename = filename
+        self.interval = interval
+        self.registry = registry or metrics
+        self.server = None
+        self._stop = threading.Event()
+        self._threads = []
+        if port is not None:
+            # 只有需要时才导入 http.server
+            from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def log_message(self, format, *args):
+                    pass
+
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = registry.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+            self.server.daemon_threads = True
+            self.port = self.server.server_address[1]
+            self._threads.append(threading.Thread(target=self.server.serve_forever, daemon=True))
+            print(f"指标地址: http://127.0.0.1:{self.port}/metrics")
+        if filename:
+            self._threads.append(threading.Thread(target=self._write_loop, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            self.registry.write(self.filename)
+
+    def close(self):
+        """停止导出，最后写一次文件"""
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.filename:
+            self.registry.write(self.filename)
+
+class RateLimiter:
+    """在所有下载线程之间共享的自适应限速器
+
+    令牌桶限制每 window 秒最多开始 rate 个下载（允许 burst 个突发）。
+    yt-dlp 报告 429/403 等限制信号时速率减半并暂停所有线程（暂停时间
+    从 backoff 开始每次加倍，最长 max_backoff），之后每成功下载一个视频
+    速率增加 increase，直到恢复为初始速率。当前速率和退避事件可通过 stats() 查看。
+    """
+
+    def __init__(self, rate=30, window=60, burst=5, min_rate=1, increase=1,
+                 backoff=10, max_backoff=300):
+        self.max_rate = rate
+        self.rate = rate
+        self.window = window
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.events = []
+        self._next_backoff = backoff
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate / self.window)
+        self._updated = now
+
+    def acquire(self, stop_event=None):
+        """等待可以开始下一个下载；stop_event 被设置时抛出 DownloadCancelled"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait_time = self._blocked_until - now
+                if wait_time <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait_time = (1 - self._tokens) * self.window / self.rate
+            if stop_event is None:
+                time.sleep(wait_time)
+            elif stop_event.wait(wait_time):
+                raise yt_dlp.utils.DownloadCancelled("用户中断下载")
+
+    def on_success(self):
+        """成功下载后逐步恢复速率"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+            self._next_backoff = self.backoff
+
+    def on_throttle(self, reason):
+        """收到限制信号：速率减半并暂停所有下载"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                # 同一次暂停期间的其他信号不再重复处理
+                return
+            self.rate = max(self.min_rate, self.rate / 2)
+            backoff = self._next_backoff
+            self._blocked_until = now + backoff
+            self._next_backoff = min(self.max_backoff, backoff * 2)
+            self.events.append({'time': time.time(), 'reason': reason, 'backoff': backoff,
+                                'rate': self.rate})
+        metrics.inc('ytdl_throttle_backoffs_total')
+        print(f"\n检测到限制 ({reason})，暂停 {backoff} 秒，"
+              f"速率降至每 {self.window} 秒 {self.rate:.1f} 个视频")
+
+    def stats(self):
+        """返回当前速率和退避次数"""
+        with self._lock:
+            return {'rate': self.rate, 'window': self.window, 'backoffs': len(self.events)}
+
+# 延迟导入不是线程安全的，多个工作线程同时第一次使用 yt_dlp 时需要加锁
+_ytdl_lock = threading.Lock()
+
+def _ytdl_classes():
+    """定义继承 yt-dlp 类的类
+
+    定义这些类需要导入 yt_dlp，因此推迟到第一次使用时；
+    模块外部仍然可以通过 downloader.RemuxOrConvertPP 等名称访问。
+    """
+    with _ytdl_lock:
+        return _define_ytdl_classes()
+
+@functools.lru_cache(maxsize=None)
+def _define_ytdl_classes():
+    class RemuxOrConvertPP(yt_dlp.postprocessor.FFmpegPostProcessor):
+        """根据编码选择封装转换或重新编码的后期处理器
+
+        FFmpegVideoConvertor 总是重新编码，对 webm/VP9/Opus 来源非常耗费CPU。
+        这里先检查编码，目标容器能容纳时只复制流（FFmpegVideoRemuxer），
+        只有确实需要时才重新编码，并打印所做的决定。只有音频的下载不转换为
+        target_ext，而是复制到与音频编码对应的容器（见 audio_container）。
+        传入 subtitles（SubtitleStage）时取回该视频的字幕，在封装转换的同一次
+        ffmpeg运行中嵌入，不再单独运行一次 FFmpegEmbedSubtitle。
+        """
+
+        def __init__(self, downloader=None, target_ext='mp4', subtitles=None):
+            super().__init__(downloader)
+            self.target_ext = target_ext
+            self.subtitles = subtitles
+
+        def run(self, info):
+            if info.get('vcodec') == 'none':
+                return self.run_audio(info)
+            tracks = self.subtitles.collect(self._downloader, info) if self.subtitles is not None else []
+            action, reason = plan_postprocessing(info, self.target_ext)
+            if action == 'transcode':
+                print(f"\n后期处理: 需要重新编码 {info['ext']} -> {self.target_ext} ({reason})")
+                pp = yt_dlp.postprocessor.FFmpegVideoConvertorPP(self._downloader, self.target_ext)
+                files_to_delete, info = pp.run(info)
+                if tracks:
+                    deleted, info = self.embed(info, tracks)
+                    files_to_delete += deleted
+                return files_to_delete, info
+            if tracks:
+                target_ext = self.target_ext if action == 'remux' else info['ext']
+                print(f"\n后期处理: 封装为 {target_ext} 并嵌入 {len(tracks)} 个字幕，不重新编码")
+                return self.embed(info, tracks, target_ext)
+            if action == 'skip':
+                return [], info
+            print(f"\n后期处理: 封装转换 {info['ext']} -> {self.target_ext}，不重新编码 ({reason})")
+            pp = yt_dlp.postprocessor.FFmpegVideoRemuxerPP(self._downloader, self.target_ext)
+            # 各步骤的耗时由 DownloadSession 的 postprocessor_hooks 记录
+            return pp.run(info)
+
+        def run_audio(self, info):
+            """仅音频：不处理字幕，只复制音频流到与编码对应的音频容器，不转换为 mp4"""
+            if self.subtitles is not None:
+                self.subtitles.discard(info)
+            target_ext = audio_container(info)
+            if target_ext is None:
+                print(f"\n后期处理: 音频编码未知，保留 {info['ext']} 格式")
+                return [], info
+            action, reason = plan_postprocessing(info, target_ext)
+            if action != 'remux':
+                return [], info
+            print(f"\n后期处理: 音频封装转换 {info['ext']} -> {target_ext}，不重新编码 ({reason})")
+            filepath = info['filepath']
+            outpath = yt_dlp.utils.replace_extension(filepath, target_ext, info['ext'])
+            temp_filename = yt_dlp.utils.prepend_extension(outpath, 'temp')
+            self.run_ffmpeg(filepath, temp_filename, ['-map', '0:a', '-dn', '-c', 'copy'])
+            os.replace(temp_filename, outpath)
+            info['filepath'] = outpath
+            info['format'] = info['ext'] = target_ext
+            return [filepath], info
+
+        def embed(self, info, tracks, target_ext=None):
+            """只复制流，一次ffmpeg运行完成封装转换和字幕嵌入，原有的字幕轨被替换
+
+            tracks 为 SubtitleStage.collect 的结果。返回 (需要删除的文件, info)。
+            """
+            target_ext = target_ext or info['ext']
+            filepath = info['filepath']
+            written = self.subtitles.write(tracks, filepath)
+            # webm 只能容纳 WebVTT 字幕，JSON 字幕无法嵌入
+            usable = [(lang, path) for lang, path, ext in written
+                      if ext != 'json' and (target_ext != 'webm' or ext == 'vtt')]
+            outpath = yt_dlp.utils.replace_extension(filepath, target_ext, info['ext'])
+            opts = [*self.stream_copy_opts(ext=target_ext), '-map', '-0:s']
+            for i, (lang, path) in enumerate(usable):
+                lang_code = yt_dlp.utils.ISO639Utils.short2long(lang.split('-')[0]) or lang
+                opts.extend(['-map', f'{i + 1}:0', f'-metadata:s:s:{i}', f'language={lang_code}'])
+            temp_filename = yt_dlp.utils.prepend_extension(outpath, 'temp')
+            self.run_ffmpeg_multiple_files([filepath, *(path for _, path in usable)], temp_filename, opts)
+            os.replace(temp_filename, outpath)
+            files_to_delete = [path for _, path, _ in written]
+            if outpath != filepath:
+                files_to_delete.append(filepath)
+            info['filepath'] = outpath
+            info['format'] = info['ext'] = target_ext
+            return files_to_delete, info
+
+    class ThrottleAwareYoutubeDL(yt_dlp.YoutubeDL):
+        """把 yt-dlp 报告的限制信号转给 RateLimiter 的 YoutubeDL
+
+        ignoreerrors 为 True 时错误不会抛出，最近一条错误信息保存在 last_error 中。
+        defer_postprocessing 为 True 时下载完成后不运行任何后期处理（包括合并分别下载的
+        视频和音频、修复和移动文件），需要的信息留在 info 中，由 PostprocessStage 运行。
+        """
+
+        rate_limiter = None
+        last_error = None
+        defer_postprocessing = False
+
+        def _check_throttle(self, message):
+            if self.rate_limiter is None or not message:
+                return
+            for marker in THROTTLE_MARKERS:
+                if marker in message:
+                    self.rate_limiter.on_throttle(marker)
+                    return
+
+        def to_screen(self, message, *args, **kwargs):
+            # 下载重试时的 "Got error: HTTP Error 429" 只通过 to_screen 输出
+            self._check_throttle(message)
+            return super().to_screen(message, *args, **kwargs)
+
+        def report_warning(self, message, *args, **kwargs):
+            self._check_throttle(message)
+            return super().report_warning(message, *args, **kwargs)
+
+        def trouble(self, message=None, *args, **kwargs):
+            self._check_throttle(message)
+            if message:
+                self.last_error = message
+            return super().trouble(message, *args, **kwargs)
+
+        def post_process(self, filename, info, files_to_move=None):
+            if not self.defer_postprocessing:
+                return super().post_process(filename, info, files_to_move)
+            # info 中保留 __postprocessors（合并、修复）、__files_to_merge 和 __finaldir
+            info['filepath'] = filename
+            info['__files_to_move'] = files_to_move or {}
+            return info
+
+    return {
+        'RemuxOrConvertPP': RemuxOrConvertPP,
+        'ThrottleAwareYoutubeDL': ThrottleAwareYoutubeDL,
+    }
+
+def __getattr__(name):
+    if name in ('RemuxOrConvertPP', 'ThrottleAwareYoutubeDL'):
+        return _ytdl_classes()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def ffmpeg_available():
+    """检查ffmpeg是否可用"""
     # 确保ffmpeg可用（用于某些格式合并）
-    try:
-        import shutil
-        if shutil.which('ffmpeg'):
-            print("已检测到ffmpeg，支持格式合并")
-            ydl_opts['postprocessors'] = [
-                {
-                    'key': 'FFmpegVideoConvertor',
-                    'preferedformat': 'mp4',  # 转换为MP4格式
-                },
-                {
-                    'key': 'FFmpegEmbedSubtitle'  # 显式嵌入字幕
-                }
+    if shutil.which('ffmpeg'):
+        print("已检测到ffmpeg，支持格式合并")
+        return True
+    print("警告: 未检测到ffmpeg，某些格式可能无法合并")
+    return False
+
+def build_postprocessors(ydl, subtitles=None, target_ext='mp4'):
+    """按执行顺序返回下载完成后需要运行的ffmpeg后期处理器
+
+    转换为MP4格式，能封装转换时不重新编码；有 subtitles（SubtitleStage）时
+    字幕在同一次ffmpeg运行中嵌入。
+    """
+    return [_ytdl_classes()['RemuxOrConvertPP'](ydl, target_ext, subtitles)]
+
+def add_postprocessors(ydl, subtitles=None, target_ext='mp4'):
+    """在有ffmpeg时添加格式转换和字幕嵌入的后期处理器，返回是否已添加"""
+    if not ffmpeg_available():
+        return False
+    for pp in build_postprocessors(ydl, subtitles, target_ext):
+        ydl.add_post_processor(pp, when='post_process')
+    return True
+
+def _print_postprocessor_timing(timings, started):
+    """创建记录每个后期处理步骤耗时的 postprocessor_hooks 钩子"""
+    def hook(d):
+        key = (threading.get_ident(), d.get('postprocessor'))
+        if d['status'] == 'started':
+            started[key] = time.monotonic()
+        elif d['status'] == 'finished' and key in started:
+            elapsed = time.monotonic() - started.pop(key)
+            timings.append((key[1], elapsed))
+            if key[1] in POSTPROCESS_STAGES:
+                metrics.observe('ytdl_stage_seconds', elapsed, stage=POSTPROCESS_STAGES[key[1]])
+            print(f"后期处理步骤 {key[1]} 用时 {elapsed:.1f} 秒")
+    return hook
+
+class SubtitleStage:
+    """与视频下载并行获取字幕
+
+    字幕文件很小，耗时主要在请求延迟上。视频开始下载时 submit 把所有语言的字幕
+    交给线程池同时获取，后期处理时 collect 取回结果，由 RemuxOrConvertPP 在封装
+    转换的同一次ffmpeg运行中嵌入。每个语言优先使用人工字幕，没有时使用自动字幕。
+    先查 cache（SubtitleCache，没有传入时使用默认的缓存文件），refresh 为 True 时
+    忽略缓存重新获取。多个会话和工作线程可以共用一个实例。
+    """
+
+    def __init__(self, langs=None, cache=None, workers=8, refresh=False):
+        self.langs = langs or DEFAULT_SUB_LANGS
+        self._owns_cache = cache is None
+        self.cache = SubtitleCache() if cache is None else cache
+        self.refresh = refresh
+        self._tracks = {}
+        self._lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='subs')
+        print(f"将下载字幕: {', '.join(self.langs)}")
+
+    def select(self, info):
+        """返回需要获取的字幕 [(语言, 类型, 字幕格式信息)]"""
+        tracks = []
+        for lang in self.langs:
+            for kind, key in (('manual', 'subtitles'), ('auto', 'automatic_captions')):
+                formats = (info.get(key) or {}).get(lang)
+                if not formats:
+                    continue
+                preferred = [f for f in formats if f.get('ext') in SUBTITLE_EXTS]
+                if preferred:
+                    chosen = min(preferred, key=lambda f: SUBTITLE_EXTS.index(f['ext']))
+                else:
+                    chosen = formats[-1]
+                tracks.append((lang, kind, chosen))
+                break
+        return tracks
+
+    def submit(self, ydl, info):
+        """开始获取一个视频的字幕，不等待结果；已经在获取（例如重试下载）时不重复提交"""
+        with self._lock:
+            if info['id'] in self._tracks:
+                return
+            self._tracks[info['id']] = [
+                self.executor.submit(self._fetch, ydl, info['id'], lang, kind, sub)
+                for lang, kind, sub in self.select(info)
             ]
+
+    def _fetch(self, ydl, video_id, lang, kind, sub):
+        ext = sub.get('ext')
+        if not self.refresh:
+            data = self.cache.get(video_id, lang, kind, ext)
+            if data is not None:
+                return lang, kind, ext, data
+        with metrics.timer('subtitle_fetch'):
+            if sub.get('data') is not None:
+                data = sub['data'].encode('utf-8')
+            else:
+                request = yt_dlp.networking.Request(sub['url'], headers=sub.get('http_headers') or {})
+                with ydl.urlopen(request) as response:
+                    data = response.read()
+        self.cache.put(video_id, lang, kind, ext, data)
+        return lang, kind, ext, data
+
+    def collect(self, ydl, info):
+        """等待并返回一个视频的字幕 [(语言, 类型, 格式, 内容)]；还没有开始获取时现在获取"""
+        with self._lock:
+            futures = self._tracks.pop(info['id'], None)
+        if futures is None:
+            self.submit(ydl, info)
+            with self._lock:
+                futures = self._tracks.pop(info['id'])
+        tracks = []
+        for future in futures:
+            try:
+                tracks.append(future.result())
+            except Exception as e:
+                print(f"字幕获取失败: {str(e)}")
+                metrics.inc('ytdl_failures_total', stage='subtitle_fetch', error=classify_error(e))
+        return tracks
+
+    def discard(self, info):
+        """不再需要某个视频的字幕（例如视频下载失败）"""
+        with self._lock:
+            futures = self._tracks.pop(info.get('id'), None) or []
+        for future in futures:
+            future.cancel()
+
+    @staticmethod
+    def write(tracks, filepath):
+        """把字幕写到视频旁边（<文件名>.<语言>.<格式>），返回 [(语言, 文件路径, 格式)]"""
+        base = os.path.splitext(filepath)[0]
+        written = []
+        for lang, kind, ext, data in tracks:
+            path = f"{base}.{lang}.{ext}"
+            with open(path, 'wb') as f:
+                f.write(data)
+            written.append((lang, path, ext))
+        return written
+
+    def close(self):
+        # 自己打开的缓存要等正在进行的获取结束后再关闭
+        self.executor.shutdown(wait=self._owns_cache, cancel_futures=True)
+        if self._owns_cache:
+            self.cache.close()
+
+class PostprocessStage:
+    """与下载分离的ffmpeg后期处理线程池
+
+    下载线程把下载完成的原始文件（分别下载的视频和音频尚未合并）交给这里处理，
+    自己立即开始下一个下载，这样网络和CPU可以同时工作。等待处理的文件最多 queue_size 个，
+    队列满时 submit 会阻塞下载线程，避免未处理的文件无限堆积。
+    字幕从 subtitles（SubtitleStage）取回，在格式转换时一起嵌入。
+    """
+
+    def __init__(self, workers=None, queue_size=None, subtitles=None, target_ext='mp4'):
+        self.workers = workers or os.cpu_count() or 1
+        self.subtitles = subtitles
+        self.target_ext = target_ext
+        self.timings = []
+        self._slots = threading.BoundedSemaphore(queue_size or self.workers * 2)
+        self.ydl = yt_dlp.YoutubeDL({
+            'postprocessor_hooks': [_print_postprocessor_timing(self.timings, {})]
+        })
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ffmpeg')
+
+    def submit(self, downloads, stop_event=None):
+        """提交一个视频下载得到的文件（requested_downloads），返回 Future
+
+        Future 的结果为处理后的文件路径。队列已满时等待空位；
+        stop_event 被设置后放弃等待并抛出 DownloadCancelled。
+        """
+        while not self._slots.acquire(timeout=0.5):
+            if stop_event is not None and stop_event.is_set():
+                raise yt_dlp.utils.DownloadCancelled("用户中断下载")
+        try:
+            future = self.executor.submit(self._run, downloads)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def _run(self, downloads):
+        # 与 YoutubeDL.post_process 相同的顺序：合并和修复、格式转换，再移出临时目录
+        filepath = None
+        for info in downloads:
+            info = dict(info)
+            info.setdefault('__files_to_move', {})
+            # 下载线程创建的后期处理器属于它的 YoutubeDL，这里重新创建
+            pps = [type(pp)(self.ydl) for pp in info.pop('__postprocessors', None) or []]
+            pps += build_postprocessors(self.ydl, self.subtitles, self.target_ext)
+            info = self.ydl.run_all_pps('post_process', info, additional_pps=pps)
+            info = self.ydl.run_pp(yt_dlp.postprocessor.MoveFilesAfterDownloadPP(self.ydl), info)
+            del info['__files_to_move']
+            filepath = info['filepath']
+        return filepath
+
+    def close(self, cancel=False):
+        """等待（或取消）剩余的后期处理任务并关闭线程池"""
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
+        self.ydl.close()
+
+class DownloadSession:
+    """在一批下载之间共享的 yt-dlp 下载器
+
+    每次创建 YoutubeDL 都要重新初始化提取器、cookie 和 HTTP 连接，
+    会话在整批下载期间只保留一个实例，每个视频只替换格式和输出模板。
+    YoutubeDL 不是线程安全的，并发下载时每个工作线程使用各自的会话。
+
+    defer_postprocessing 为 True 时不运行任何后期处理（合并、格式转换和字幕嵌入），
+    由调用方把 downloads 中的文件交给 PostprocessStage 处理。rate_limiter 会收到下载中
+    出现的限制信号。throughput（ThroughputEstimator）记录每个下载的速度，
+    供 'auto' 格式在 time_budget 秒内选择最佳格式，多个会话可以共用一个。
+    fragments 为分片格式每个视频同时下载的分片数。
+
+    download_subs 为 True 时字幕由 subtitles（SubtitleStage，多个会话可以共用）
+    与视频并行获取，没有传入时会话自己创建一个。没有ffmpeg时字幕保存为单独的文件。
+
+    disk_budget（DiskSpaceBudget，多个会话共用）决定下载何时开始，见
+    reserve_disk_space；推迟后期处理时预留的空间留在 reservation 中。
+    scratch_path 不为空时未完成的文件和合并前的分段保存在这个目录中，
+    完成后移动到输出目录；两者在同一文件系统上时移动只是重命名。
+    """
+
+    def __init__(self, download_subs=True, sub_langs=None, progress_hooks=None,
+                 defer_postprocessing=False, rate_limiter=None, throughput=None,
+                 time_budget=AUTO_TIME_BUDGET, fragments=FRAGMENT_CONCURRENCY, subtitles=None,
+                 disk_budget=None, scratch_path=None):
+        # 进度钩子通过 _progress 转发，可以按视频替换 progress_hooks
+        self.progress_hooks = progress_hooks or [progress_hook]
+        ydl_opts = build_download_options([self._progress], fragments)
+        ydl_opts['post_hooks'] = [self._finished]
+        # 最近一次下载中每个后期处理步骤的耗时
+        self.pp_timings = []
+        ydl_opts['postprocessor_hooks'] = [_print_postprocessor_timing(self.pp_timings, {})]
+        self.ydl = _ytdl_classes()['ThrottleAwareYoutubeDL'](ydl_opts)
+        self.ydl.rate_limiter = self.rate_limiter = rate_limiter
+        self.ydl.defer_postprocessing = defer_postprocessing
+        self.subtitles = subtitles if download_subs else None
+        self._owns_subtitles = download_subs and subtitles is None
+        if self._owns_subtitles:
+            self.subtitles = SubtitleStage(sub_langs)
+        # 字幕的去向：嵌入视频（后期处理器或 PostprocessStage）或保存为单独的文件
+        self._embeds_subtitles = defer_postprocessing
+        if not defer_postprocessing:
+            self._embeds_subtitles = add_postprocessors(self.ydl, self.subtitles)
+        # 最近一次下载得到的文件信息（requested_downloads）
+        self.downloads = []
+        self._format_selectors = {}
+        # 最近一次下载（含后期处理）生成的文件
+        self.filepath = None
+        # 当前未完成的文件及其进度，下载完成后为 None
+        self.partial = None
+        self.throughput = throughput or ThroughputEstimator()
+        self.time_budget = time_budget
+        # 最近一次下载失败的错误类别（见 classify_error），成功时为 None
+        self.error_class = None
+        self.disk_budget = disk_budget
+        self.scratch_path = scratch_path
+        self.defer_postprocessing = defer_postprocessing
+        # 推迟后期处理时，最近一次成功下载的磁盘预留（ExitStack），由调用方在后期处理结束后关闭
+        self.reservation = None
+
+    def _progress(self, d):
+        if d['status'] == 'downloading':
+            self.partial = {
+                'tmpfilename': d.get('tmpfilename'),
+                'downloaded_bytes': d.get('downloaded_bytes', 0),
+                'total_bytes': d.get('total_bytes') or d.get('total_bytes_estimate'),
+                'fragment_index': d.get('fragment_index'),
+                'fragment_count': d.get('fragment_count')
+            }
+        elif d['status'] == 'finished':
+            self.partial = None
+            nbytes = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+            metrics.inc('ytdl_downloaded_bytes_total', nbytes)
+            self.throughput.add(nbytes, d.get('elapsed'))
+        for hook in self.progress_hooks:
+            hook(d)
+
+    def _finished(self, filepath):
+        self.filepath = filepath
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """关闭下载器及其HTTP连接"""
+        if self._owns_subtitles and self.subtitles is not None:
+            self.subtitles.close()
+            self.subtitles = None
+        if self.ydl is not None:
+            self.ydl.close()
+            self.ydl = None
+
+    def _set_format(self, format_id):
+        """替换格式选择器，同一格式只解析一次"""
+        selector = self._format_selectors.get(format_id)
+        if selector is None:
+            selector = self.ydl.build_format_selector(format_id)
+            self._format_selectors[format_id] = selector
+        self.ydl.params['format'] = format_id
+        self.ydl.format_selector = selector
+
+    def select_formats(self, info, format_id):
+        """返回 format_id 在 info 中会选中的格式（不下载），无法确定时返回 []"""
+        formats = [dict(f) for f in info.get('formats') or []]
+        if not formats:
+            return []
+        try:
+            self.ydl.sort_formats({'formats': formats})
+            self._set_format(format_id)
+            return self.ydl._select_formats(formats, self.ydl.format_selector)
+        except Exception:
+            return []
+
+    @contextlib.contextmanager
+    def reserve_disk_space(self, info, format_id):
+        """在 with 块期间为下载 info 预留磁盘空间，没有 disk_budget 时不做任何事
+
+        空间不足时等待其他下载完成；没有其他下载时也放不下则抛出 OSError（ENOSPC）。
+        """
+        if self.disk_budget is None:
+            yield 0
+            return
+        nbytes = estimate_footprint(self.select_formats(info, format_id), info.get('duration'))
+        with self.disk_budget.reserve_space(nbytes):
+            yield nbytes
+
+    def resolve(self, url):
+        """提取视频信息但不处理格式，结果可以直接传给 download"""
+        with metrics.timer('extract'):
+            return self.ydl.extract_info(url, download=False, process=False)
+
+    def download(self, url, format_id, output_path=None, info=None):
+        """使用指定格式和输出路径下载一个视频，返回 yt-dlp 的返回码
+
+        传入已提取的 info 时直接交给 process_ie_result，不再重新提取。
+        """
+        self._set_format(format_id)
+        if self.scratch_path:
+            # 输出路径作为 yt-dlp 的 home，未完成的文件在 scratch_path 中，完成后由 MoveFiles 移过去
+            self.ydl.params['paths'] = {'home': output_path or '.',
+                                        'temp': os.path.abspath(self.scratch_path)}
+            self.ydl.params['outtmpl']['default'] = _output_template(None)
         else:
-            print("警告: 未检测到ffmpeg，某些格式可能无法合并")
-    except ImportError:
-        print("警告: 无法检查ffmpeg可用性")
+            self.ydl.params['paths'] = {}
+            self.ydl.params['outtmpl']['default'] = _output_template(output_path)
+        self.filepath = None
+        self.partial = None
+        del self.pp_timings[:]
+        self.downloads = []
+        self.error_class = None
+        self.ydl.last_error = None
+        # 返回码在实例上累积，每个视频单独计算
+        self.ydl._download_retcode = 0
+        # 仅音频的下载不需要字幕
+        audio_only = is_audio_only(format_id, info)
+        if self.subtitles is not None and info is not None and not audio_only:
+            # 字幕与视频同时获取，后期处理时再取回
+            self.subtitles.submit(self.ydl, info)
+        started = time.monotonic()
+        try:
+            if info is None:
+                result = self.ydl.extract_info(url, download=True)
+            else:
+                result = self.ydl.process_ie_result(dict(info), download=True)
+        finally:
+            # 在下载线程中运行的后期处理单独计时
+            elapsed = time.monotonic() - started - sum(t for _, t in self.pp_timings)
+            metrics.observe('ytdl_stage_seconds', elapsed, stage='download')
+        # requested_downloads 中与视频信息相同的字段已被 yt-dlp 删除，合并回完整信息
+        result = result or {}
+        self.downloads = [
+            {**{k: v for k, v in result.items() if k != 'requested_downloads'}, **d}
+            for d in result.get('requested_downloads') or []
+        ]
+        if self.ydl._download_retcode:
+            # 字幕留给重试使用，最终失败时由 download_video 放弃
+            self.error_class = classify_error(self.ydl.last_error)
+        elif (self.subtitles is not None and not self._embeds_subtitles and self.filepath
+              and not audio_only and result.get('vcodec') != 'none'):
+            self.subtitles.write(self.subtitles.collect(self.ydl, result), self.filepath)
+        return self.ydl._download_retcode
+
+    def extract_info(self, url, process=True, **params):
+        """临时覆盖部分参数并提取信息（不下载）"""
+        saved = {key: self.ydl.params.get(key) for key in params}
+        self.ydl.params.update(params)
+        try:
+            with metrics.timer('extract'):
+                return self.ydl.extract_info(url, download=False, process=process)
+        finally:
+            self.ydl.params.update(saved)
+
+class SessionPool:
+    """每个工作线程一个 DownloadSession，全部下载结束后统一关闭
+
+    工作线程第一次调用 get 时用 DownloadSession(**options) 创建自己的会话。
+    进度由调用方汇总显示，会话关闭 yt-dlp 自己的进度行。
+    """
+
+    def __init__(self, **options):
+        self.options = options
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = DownloadSession(**self.options)
+            session.ydl.params['noprogress'] = True
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+        for session in sessions:
+            session.close()
+
+def limit_connections(workers, fragments, max_connections=MAX_CONNECTIONS):
+    """返回 (workers, fragments)：同时下载的视频数 × 每个视频的分片数不超过 max_connections"""
+    workers = max(1, min(int(workers or 1), max_connections))
+    return workers, max(1, min(fragments, max_connections // workers))
+
+def download_video(url, format_id=None, output_path=None, download_subs=True, sub_langs=None,
+                   progress_hooks=None, session=None, info=None, cache=None):
+    """下载视频
+
+    progress_hooks 为空时使用默认的 progress_hook；并发下载时由调用方传入
+    带工作线程标识的钩子。传入 session 时复用其中的下载器，
+    download_subs、sub_langs 和 progress_hooks 以会话的配置为准。
+    info 为之前提取的视频信息（例如 get_available_formats 返回的 'info'），
+    没有时只提取一次（有 cache 时先查缓存），正常下载和备用下载方法都使用同一份信息。
+    format_id 为 'auto' 时由 choose_auto_format 按会话实测的下载速度选择。
+    获取信息或下载失败时按 classify_error 的类别和 RETRY_BUDGETS 重试，
+    类别保存在 session.error_class。
+    """
+    # 如果没有指定格式，使用最佳格式
+    if not format_id:
+        print("未指定格式，将使用最佳视频+音频格式")
+        format_id = 'bestvideo+bestaudio/best'
+    
+    if session is None:
+        with DownloadSession(download_subs, sub_langs, progress_hooks) as session:
+            return download_video(url, format_id, output_path, session=session, info=info,
+                                  cache=cache)
+    
+    saved_hooks = session.progress_hooks
+    if progress_hooks:
+        session.progress_hooks = progress_hooks
     
     # 开始下载
+    session.error_class = None
+    session.ydl.last_error = None
+    reservation = contextlib.ExitStack()
+    # 每类错误已经重试的次数，获取信息和下载共用 RETRY_BUDGETS 中的次数
+    retries = collections.Counter()
+    result = None
+    error = None
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            result = ydl.download([url])
-            if result != 0:
-                print("警告: 下载可能未完全成功")
-            return result
-    except Exception as e:
-        print(f"下载错误: {str(e)}")
-        print("尝试使用备用下载方法...")
+        if info is None and cache:
+            info = cache.get('video', url, cache.format_ttl)
+        while info is None:
+            session.ydl.last_error = None
+            # 不处理格式：格式只在 session.download 中按本次的 format_id 选择
+            info = session.resolve(url)
+            if info is not None:
+                if cache:
+                    cache.put('video', url, info)
+                break
+            error_class = session.error_class = classify_error(session.ydl.last_error)
+            if retries[error_class] >= RETRY_BUDGETS[error_class]:
+                print(f"警告: 无法获取视频信息 (错误类别: {error_class})")
+                metrics.inc('ytdl_failures_total', stage='extract', error=error_class)
+                return 1
+            retries[error_class] += 1
+            metrics.inc('ytdl_retries_total', kind=error_class)
+            delay = retry_delay(retries[error_class])
+            print(f"\n获取视频信息失败 ({error_class})，{delay:.1f} 秒后重试 "
+                  f"(第 {retries[error_class]}/{RETRY_BUDGETS[error_class]} 次)...")
+            time.sleep(delay)
+        session.error_class = None
+        if format_id == PRESET_FORMATS['auto']:
+            format_id = choose_auto_format(session, info, session.time_budget)
+        # 磁盘空间允许时才开始，预留的空间在重试（推迟的后期处理）结束后释放
+        reservation.enter_context(session.reserve_disk_space(info, format_id))
         
-        # 备用下载方法
-        backup_opts = ydl_opts.copy()
-        backup_opts['format'] = 'best'  # 使用单一最佳格式
-        try:
-            with yt_dlp.YoutubeDL(backup_opts) as ydl:
-                return ydl.download([url])
-        except Exception as e2:
-            print(f"备用下载方法也失败: {str(e2)}")
-            raise
+        # 按错误类别重试：传输中断时用相同格式从 .part 文件末尾继续，
+        # 格式不可用时改用 best，永久错误不再重试。下载抛出的异常按同样的规则重试，
+        # 次数用完后再抛出
+        while True:
+            error = None
+            try:
+                result = session.download(url, format_id, output_path, info)
+            except yt_dlp.utils.DownloadCancelled:
+                raise
+            except Exception as e:
+                print(f"下载错误: {str(e)}")
+                error = e
+                session.error_class = classify_error(e)
+                result = 1
+            if result == 0:
+                break
+            error_class = session.error_class
+            if retries[error_class] >= RETRY_BUDGETS[error_class]:
+                if error is not None:
+                    raise error
+                break
+            retries[error_class] += 1
+            if error_class == 'format':
+                print("\n请求的格式不可用，改用单一最佳格式...")
+                metrics.inc('ytdl_fallbacks_total')
+                format_id = 'best'
+            else:
+                metrics.inc('ytdl_retries_total', kind='resume' if session.partial else error_class)
+                delay = retry_delay(retries[error_class])
+                where = f"从第 {session.partial['downloaded_bytes']} 字节" if session.partial else ""
+                print(f"\n下载失败 ({error_class})，{delay:.1f} 秒后{where}重试 "
+                      f"(第 {retries[error_class]}/{RETRY_BUDGETS[error_class]} 次)...")
+                time.sleep(delay)
+        
+        if result != 0:
+            metrics.inc('ytdl_failures_total', stage='download', error=session.error_class)
+            print(f"警告: 下载可能未完全成功 (错误类别: {session.error_class})")
+        return result
+    except yt_dlp.utils.DownloadCancelled:
+        # 用户中断，不再重试
+        raise
+    except Exception as e:
+        if e is not error:
+            # 选择格式或预留磁盘空间时出错，下载本身的异常已经在上面打印和分类
+            print(f"下载错误: {str(e)}")
+            session.error_class = classify_error(e)
+        metrics.inc('ytdl_failures_total', stage='download', error=session.error_class)
+        if session.error_class == 'disk':
+            print("磁盘空间不足，本次运行不再重试")
+        elif session.error_class == 'permanent':
+            print("该视频无法下载，不再重试")
+        raise
+    finally:
+        if result != 0 and session.subtitles is not None and info is not None:
+            # 所有重试都失败后不再需要这个视频的字幕
+            session.subtitles.discard(info)
+        if result == 0 and session.defer_postprocessing:
+            # 原始文件在后期处理结束前仍然占用磁盘，预留的空间交给调用方释放
+            session.reservation = reservation.pop_all()
+        reservation.close()
+        session.progress_hooks = saved_hooks
 
 def progress_hook(d):
-    """显示下载进度的钩子函数"""
+    """显示下载进度的钩子函数，每 PROGRESS_INTERVAL 秒最多刷新一次"""
     if d['status'] == 'downloading':
+        now = time.monotonic()
+        if now - _last_progress[0] < PROGRESS_INTERVAL:
+            return
+        _last_progress[0] = now
         percent = d.get('_percent_str', '未知')
         speed = d.get('_speed_str', '未知')
         eta = d.get('_eta_str', '未知')
         print(f"\r下载中: {percent} 速度: {speed} 预计剩余时间: {eta}", end='')
     elif d['status'] == 'finished':
+        _last_progress[0] = 0.0
         print("\n下载完成！正在进行最终处理...")
 
-def get_playlist_info(playlist_url):
-    """获取播放列表信息"""
+# progress_hook 上次刷新的时间
+_last_progress = [0.0]
+
+def make_worker_progress_hook(label, stop_event=None, reporter=None):
+    """为并发下载创建带工作线程标识的进度钩子
+
+    钩子本身只把进度交给 reporter（ProgressReporter），显示由 reporter
+    按固定频率汇总完成。stop_event 被设置后钩子会中断当前下载。
+    """
+    def hook(d):
+        if stop_event is not None and stop_event.is_set():
+            raise yt_dlp.utils.DownloadCancelled("用户中断下载")
+        if reporter is not None:
+            reporter.update(label, d)
+
+    return hook
+
+def _format_eta(seconds):
+    if seconds is None:
+        return "未知"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+class ProgressReporter:
+    """汇总所有正在进行的下载，按固定频率输出进度
+
+    yt-dlp 每收到一块数据就调用一次进度钩子，分片下载时每秒可达数百次。
+    update 只保存最新的进度字典，后台线程每 interval 秒采样一次，
+    输出所有下载的总速度、剩余时间和已完成视频的大小。
+    mode 为 'line' 时打印一行中文汇总，为 'json' 时每次采样输出一行 JSON
+    （默认写到 stderr，便于与日志分开）。
+    """
+
+    def __init__(self, mode='line', interval=1.0, stream=None):
+        self.mode = mode
+        self.interval = interval
+        self.stream = stream or (sys.stderr if mode == 'json' else sys.stdout)
+        self._active = {}
+        self._finished = collections.deque()
+        self._stop = threading.Event()
+        # 每个视频下载的字节数（视频和音频分开下载时合计）
+        self.video_bytes = {}
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, label, d):
+        """在下载线程中调用，只记录最新状态"""
+        if d['status'] == 'downloading':
+            self._active[label] = d
+        else:
+            self._active.pop(label, None)
+            if d['status'] == 'finished':
+                self._finished.append(d)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _collect_finished(self):
+        videos = []
+        while self._finished:
+            d = self._finished.popleft()
+            info = d.get('info_dict') or {}
+            key = info.get('id') or d.get('filename')
+            size = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+            self.video_bytes[key] = self.video_bytes.get(key, 0) + size
+            videos.append({'id': key, 'title': info.get('title'), 'filename': d.get('filename'),
+                           'bytes': size, 'elapsed': d.get('elapsed')})
+        return videos
+
+    def _sample(self):
+        finished = self._collect_finished()
+        active = []
+        speed = 0
+        remaining = 0
+        for label, d in list(self._active.items()):
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            downloaded = d.get('downloaded_bytes') or 0
+            speed += d.get('speed') or 0
+            if total:
+                remaining += max(0, total - downloaded)
+            active.append({'label': label, 'downloaded_bytes': downloaded, 'total_bytes': total,
+                           'speed': d.get('speed'), 'eta': d.get('eta')})
+        eta = remaining / speed if speed else None
+        
+        if self.mode == 'json':
+            record = {'time': round(time.time(), 3), 'speed': speed, 'eta': eta,
+                      'active': active, 'finished': finished,
+                      'completed_videos': len(self.video_bytes)}
+            self.stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        elif active:
+            parts = []
+            for a in active:
+                percent = f"{a['downloaded_bytes'] * 100 / a['total_bytes']:.0f}%" if a['total_bytes'] else "?"
+                parts.append(f"{a['label']} {percent}")
+            self.stream.write(f"[进度] {len(active)} 个下载中  总速度 {speed / 1024 / 1024:.2f} MiB/s  "
+                              f"剩余 {_format_eta(eta)}  已完成 {len(self.video_bytes)} 个  "
+                              f"| {'  '.join(parts)}\n")
+        else:
+            return
+        self.stream.flush()
+
+    def summary(self):
+        """返回已完成视频的数量、总字节数和平均速度"""
+        total = sum(self.video_bytes.values())
+        elapsed = time.monotonic() - self.started
+        return {'videos': len(self.video_bytes), 'bytes': total,
+                'speed': total / elapsed if elapsed else 0}
+
+    def close(self):
+        """停止采样，输出最后一次汇总"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self._collect_finished()
+        summary = self.summary()
+        if self.mode == 'json':
+            self.stream.write(json.dumps(dict(summary, event='summary'), ensure_ascii=False) + "\n")
+            self.stream.flush()
+        else:
+            print(f"共下载 {summary['videos']} 个视频，{summary['bytes'] / 1024 / 1024:.1f} MiB，"
+                  f"平均 {summary['speed'] / 1024 / 1024:.2f} MiB/s")
+
+def get_playlist_info(playlist_url, session=None, cache=None):
+    """获取播放列表信息
+
+    传入 cache 时优先使用未超过 ttl 的缓存信息。
+    """
     ydl_opts = {
         'quiet': True,
         'extract_flat': True,  # 不下载，只获取信息
@@ -179,124 +2003,1411 @@ def get_playlist_info(playlist_url):
     print("正在获取播放列表信息...")
     
     try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            playlist_info = ydl.extract_info(playlist_url, download=False)
-            
-            if not playlist_info:
-                print("错误: 无法获取播放列表信息")
-                return None
-            
-            videos = []
-            if 'entries' in playlist_info:
-                for entry in playlist_info['entries']:
-                    if entry:
-                        videos.append({
-                            'id': entry.get('id', ''),
-                            'title': entry.get('title', 'Unknown'),
-                            'url': f"https://www.youtube.com/watch?v={entry.get('id', '')}",
-                            'status': 'pending'
-                        })
-            
-            return {
-                'title': playlist_info.get('title', 'Unknown Playlist'),
-                'id': playlist_info.get('id', ''),
-                'videos': videos
-            }
+        playlist_info = cache.get('playlist', playlist_url) if cache else None
+        if playlist_info is not None:
+            print("使用缓存的播放列表信息")
+        else:
+            if session is None:
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl, metrics.timer('extract'):
+                    playlist_info = ydl.extract_info(playlist_url, download=False)
+            else:
+                playlist_info = session.extract_info(playlist_url, ignoreerrors=False, **ydl_opts)
+            if cache and playlist_info:
+                cache.put('playlist', playlist_url, playlist_info)
+        
+        if not playlist_info:
+            print("错误: 无法获取播放列表信息")
+            return None
+        
+        videos = []
+        if 'entries' in playlist_info:
+            for entry in playlist_info['entries']:
+                if entry:
+                    videos.append(_playlist_video(entry))
+        
+        return {
+            'title': playlist_info.get('title', 'Unknown Playlist'),
+            'id': playlist_info.get('id', ''),
+            'videos': videos
+        }
     except Exception as e:
         print(f"获取播放列表信息出错: {str(e)}")
+        metrics.inc('ytdl_failures_total', stage='extract', error=classify_error(e))
         return None
 
+def _playlist_video(entry):
+    """把播放列表条目转换为下载状态中的视频记录"""
+    url = entry.get('url') if entry.get('_type') == 'url' else None
+    return {
+        'id': entry.get('id', ''),
+        'title': entry.get('title', 'Unknown'),
+        'url': url or f"https://www.youtube.com/watch?v={entry.get('id', '')}",
+        'status': 'pending'
+    }
+
+class PlaylistStream:
+    """逐页展开的播放列表
+
+    与 get_playlist_info 不同，条目在迭代时才按页获取，不会先把整个频道读入内存。
+    position 为已经处理过的条目数，创建时传入 start 可以从该位置继续
+    （yt-dlp 按页获取，跳过的条目所在的页仍会被请求，但不会保留在内存中）。
+    没有传入 session 时使用自己的 YoutubeDL，可以在其他线程中迭代。
+    """
+
+    def __init__(self, playlist_url, session=None, start=0):
+        opts = {'quiet': True, 'extract_flat': True, 'skip_download': True}
+        self._ydl = None
+        if session is None:
+            self._ydl = yt_dlp.YoutubeDL(dict(opts, ignoreerrors=False))
+            extract = lambda url: self._ydl.extract_info(url, download=False, process=False)
+        else:
+            extract = lambda url: session.extract_info(url, process=False, ignoreerrors=False, **opts)
+        with metrics.timer('extract'):
+            info = extract(playlist_url)
+            # 带有 list= 的视频链接等会先解析为指向播放列表的链接
+            while info and info.get('_type') in ('url', 'url_transparent'):
+                info = extract(info['url'])
+        if not info:
+            raise ValueError("无法获取播放列表信息")
+        self.id = info.get('id', '')
+        self.title = info.get('title', 'Unknown Playlist')
+        self.position = start
+        self._entries = info.get('entries') or []
+
+    def __iter__(self):
+        try:
+            for entry in itertools.islice(self._entries, self.position, None):
+                self.position += 1
+                if entry:
+                    yield _playlist_video(entry)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._ydl is not None:
+            self._ydl.close()
+            self._ydl = None
+
+def expand_sources(urls, cursor=None):
+    """依次展开多个URL：播放列表逐页展开，其他URL作为单个视频
+
+    产生 (cursor, video)，cursor 为 {'source': URL序号, 'position': 条目序号}，
+    表示该视频之后从哪里继续；把保存的 cursor 传回来即可从中断处继续展开。
+    """
+    cursor = cursor or {}
+    first, position = cursor.get('source', 0), cursor.get('position', 0)
+    for source in range(first, len(urls)):
+        url = urls[source]
+        start = position if source == first else 0
+        if _is_playlist_url(url):
+            try:
+                stream = PlaylistStream(url, start=start)
+            except Exception as e:
+                print(f"无法获取播放列表信息，将尝试作为单个视频下载: {url} ({str(e)})")
+            else:
+                print(f"正在展开播放列表: {stream.title}")
+                for video in stream:
+                    yield {'source': source, 'position': stream.position}, video
+                continue
+        if start == 0:
+            yield {'source': source + 1, 'position': 0}, {'url': url, 'title': url, 'status': 'pending'}
+
+def _write_snapshot(state, filename):
+    """原子地写入完整状态：先写临时文件再替换，写入中途崩溃不会损坏原文件"""
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
 def save_download_state(state, filename="download_state.json"):
-    """保存下载状态到文件"""
+    """保存下载状态到文件
+
+    写入完整快照并清空对应的日志文件。
+    """
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(state, f, ensure_ascii=False, indent=2)
+        with metrics.timer('state_save'):
+            _write_snapshot(state, filename)
+        if os.path.exists(filename + '.journal'):
+            os.remove(filename + '.journal')
         print(f"下载状态已保存到 {filename}")
     except Exception as e:
         print(f"保存下载状态出错: {str(e)}")
 
+def _replay_journal(state, journal_filename):
+    """把日志中的记录依次应用到快照上
+
+    日志第一行记录它所属快照的 journal_generation。合并日志时先写新快照再清空日志，
+    如果在两步之间崩溃，旧日志的代数与新快照不同，其中的记录已经包含在快照里，
+    直接忽略（追加视频的记录重放两次会产生重复的视频）。
+    """
+    if not os.path.exists(journal_filename):
+        return
+    videos = state.get('videos', [])
+    with open(journal_filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 崩溃时最后一行可能只写了一半
+                break
+            if 'g' in record:
+                if record['g'] != state.get('journal_generation'):
+                    return
+                continue
+            index = record.pop('i', None)
+            if 'a' in record:
+                # 展开播放列表时追加的视频
+                videos.append(record.pop('a'))
+                state.update(record)
+            elif index is None:
+                state.update(record)
+            elif 0 <= index < len(videos):
+                videos[index].update(record)
+
 def load_download_state(filename="download_state.json"):
-    """从文件加载下载状态"""
+    """从文件加载下载状态（快照加上日志中的后续修改）"""
     try:
         if os.path.exists(filename):
             with open(filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
+                state = json.load(f)
+            _replay_journal(state, filename + '.journal')
+            return state
         return None
     except Exception as e:
         print(f"加载下载状态出错: {str(e)}")
         return None
 
-def download_playlist(playlist_info, format_id, output_path, start_from=0):
-    """下载播放列表中的视频"""
-    if not playlist_info or not playlist_info.get('videos'):
+class StateJournal:
+    """只追加的下载状态日志
+
+    每次状态变化只在 <filename>.journal 末尾追加一行JSON，而不是重写整个
+    download_state.json。fsync 按 sync_every 条记录批量进行；日志超过
+    compact_every 条记录且不少于当前视频数量时，把当前状态原子地写成新快照并清空日志，
+    这样边展开边追加视频时写入快照的总量仍与视频数量成正比。
+    load_download_state 会读取快照并重放日志，因此读取方无需关心日志的存在。
+    """
+
+    def __init__(self, state, filename="download_state.json", sync_every=50, compact_every=1000):
+        self.state = state
+        self.filename = filename
+        self.journal_filename = filename + '.journal'
+        self.sync_every = sync_every
+        self.compact_every = compact_every
+        self.bytes_written = 0
+        self._records = 0
+        self._unsynced = 0
+        self._file = None
+        self.compact()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(self, index=None, **changes):
+        """记录一条修改：index 为视频序号，为 None 时修改播放列表级别的字段"""
+        if index is None:
+            self.state.update(changes)
+        else:
+            self.state['videos'][index].update(changes)
+            changes = dict(changes, i=index)
+        self._write(changes)
+
+    def append(self, video, **changes):
+        """追加一个视频，同时修改播放列表级别的字段（例如展开进度）"""
+        self.state['videos'].append(video)
+        self.state.update(changes)
+        self._write(dict(changes, a=video))
+
+    def _write(self, changes):
+        line = json.dumps(changes, ensure_ascii=False) + '\n'
+        with metrics.timer('state_save'):
+            self._file.write(line)
+            self._file.flush()
+            self.bytes_written += len(line.encode('utf-8'))
+            self._records += 1
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                self.sync()
+        if self._records >= max(self.compact_every, len(self.state['videos'])):
+            self.compact()
+
+    def sync(self):
+        """把日志刷到磁盘"""
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def compact(self):
+        """把当前状态写成新快照并清空日志，新日志的第一行为快照的代数"""
+        if self._file is not None:
+            self._file.close()
+        generation = self.state.get('journal_generation', 0) + 1
+        self.state['journal_generation'] = generation
+        with metrics.timer('state_save'):
+            _write_snapshot(self.state, self.filename)
+        self.bytes_written += os.path.getsize(self.filename)
+        self._file = open(self.journal_filename, 'w', encoding='utf-8')
+        header = json.dumps({'g': generation}) + '\n'
+        self._file.write(header)
+        self._file.flush()
+        self.bytes_written += len(header)
+        self._records = 0
+        self._unsynced = 0
+
+    def close(self):
+        """合并日志并关闭"""
+        if self._file is not None:
+            self.compact()
+            self._file.close()
+            self._file = None
+            os.remove(self.journal_filename)
+
+class JobQueue:
+    """多个节点共享的下载任务队列（SQLite，文件可以放在共享目录中）
+
+    同一批URL（name）的每个视频一行，字段与下载状态文件相同：status、attempts、
+    error_class、partial 和 filename。节点用 lease 领取视频，租约 lease_time 秒后过期，
+    节点运行期间由 heartbeat 定期续约；节点退出或崩溃后租约过期，视频回到队列中
+    由其他节点继续（共享下载目录时从 .part 文件继续）。只有仍持有租约的节点能用
+    complete 提交结果，因此同一时刻一个视频只会由一个节点下载。
+
+    播放列表也只由一个节点展开：claim_expansion 领取展开租约，展开的视频通过 add
+    写入队列，其他节点同时领取已展开的视频；展开节点中断后其他节点从记录的位置继续。
+    展开出错时用 release_expansion 交还租约，多次失败后用 abandon_expansion 放弃，
+    已展开的视频照常下载。换用其他存储时实现相同的方法即可。
+    """
+
+    def __init__(self, filename="job_queue.sqlite", name='default', node=None, lease_time=120):
+        self.filename = filename
+        self.name = name
+        self.node = node or f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_time = lease_time
+        self._lock = threading.Lock()
+        # 自己管理事务，领取视频时用 BEGIN IMMEDIATE 保证多个节点不会领到同一视频
+        self._db = sqlite3.connect(filename, timeout=60, check_same_thread=False,
+                                   isolation_level=None)
+        with self._transaction():
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "queue TEXT NOT NULL, url TEXT NOT NULL, position INTEGER NOT NULL, "
+                "title TEXT, status TEXT NOT NULL DEFAULT 'pending', "
+                "attempts INTEGER NOT NULL DEFAULT 0, error_class TEXT, filename TEXT, "
+                "partial TEXT, node TEXT, lease_expires REAL, PRIMARY KEY (queue, url))"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (queue, status, position)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS queues ("
+                "name TEXT PRIMARY KEY, expanded TEXT, expansion_complete INTEGER NOT NULL DEFAULT 0, "
+                "node TEXT, lease_expires REAL)"
+            )
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(queues)")]
+            if 'expansion_error' not in columns:
+                self._db.execute("ALTER TABLE queues ADD COLUMN expansion_error TEXT")
+            if 'next_position' not in columns:
+                # 下一个加入的视频的序号，加入视频时不必每次统计行数
+                self._db.execute("ALTER TABLE queues ADD COLUMN next_position INTEGER NOT NULL DEFAULT 0")
+                self._db.execute("UPDATE queues SET next_position = "
+                                 "(SELECT COUNT(*) FROM jobs WHERE jobs.queue = queues.name)")
+            self._db.execute("INSERT OR IGNORE INTO queues (name) VALUES (?)", (name,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def claim_expansion(self):
+        """领取展开播放列表的租约
+
+        返回 (是否领取成功, 上次展开到的 cursor)；已经展开完成或其他节点正在展开时领取失败。
+        """
+        now = time.time()
+        with self._transaction():
+            expanded, complete, node, expires = self._db.execute(
+                "SELECT expanded, expansion_complete, node, lease_expires FROM queues WHERE name = ?",
+                (self.name,)
+            ).fetchone()
+            if complete or (node not in (None, self.node) and expires > now):
+                return False, None
+            self._db.execute("UPDATE queues SET node = ?, lease_expires = ? WHERE name = ?",
+                             (self.node, now + self.lease_time, self.name))
+        return True, json.loads(expanded) if expanded else None
+
+    def add(self, video, cursor):
+        """加入一个展开得到的视频并记录展开位置；已失去展开租约时返回 False"""
+        with self._transaction():
+            owner, position = self._db.execute(
+                "SELECT node, next_position FROM queues WHERE name = ?", (self.name,)
+            ).fetchone()
+            if owner != self.node:
+                return False
+            added = self._db.execute(
+                "INSERT OR IGNORE INTO jobs (queue, url, position, title) VALUES (?, ?, ?, ?)",
+                (self.name, video['url'], position, video.get('title'))
+            ).rowcount
+            self._db.execute("UPDATE queues SET expanded = ?, next_position = ? WHERE name = ?",
+                             (json.dumps(cursor), position + added, self.name))
+        return True
+
+    def finish_expansion(self):
+        """标记展开完成"""
+        with self._transaction():
+            self._db.execute(
+                "UPDATE queues SET expansion_complete = 1, node = NULL, lease_expires = NULL "
+                "WHERE name = ? AND node = ?", (self.name, self.node)
+            )
+
+    def release_expansion(self):
+        """展开出错时交还展开租约，下次从记录的位置继续"""
+        with self._transaction():
+            self._db.execute("UPDATE queues SET node = NULL, lease_expires = NULL "
+                             "WHERE name = ? AND node = ?", (self.name, self.node))
+
+    def abandon_expansion(self, error):
+        """放弃展开：记录错误并标记展开结束，所有节点不再展开，已展开的视频照常下载"""
+        with self._transaction():
+            self._db.execute(
+                "UPDATE queues SET expansion_complete = 1, expansion_error = ?, node = NULL, "
+                "lease_expires = NULL WHERE name = ? AND node = ?", (error, self.name, self.node)
+            )
+
+    def expansion_error(self):
+        """放弃展开时记录的错误，没有放弃时为 None"""
+        with self._lock:
+            row = self._db.execute("SELECT expansion_error FROM queues WHERE name = ?",
+                                   (self.name,)).fetchone()
+        return row[0]
+
+    def expansion_complete(self):
+        with self._lock:
+            row = self._db.execute("SELECT expansion_complete FROM queues WHERE name = ?",
+                                   (self.name,)).fetchone()
+        return bool(row[0])
+
+    def lease(self, count=1, max_attempts=3):
+        """领取最多 count 个视频：先待下载和租约已过期的，再重试失败次数少于 max_attempts 的
+
+        永久错误（error_class 为 'permanent'）的视频不再领取。返回视频状态字典的列表。
+        """
+        now = time.time()
+        with self._transaction():
+            rows = self._db.execute(
+                "SELECT url, title, position, status, attempts, error_class, partial FROM jobs "
+                "WHERE queue = ? AND (status = 'pending' "
+                "OR (status = 'leased' AND lease_expires < ?) "
+                "OR (status = 'failed' AND attempts < ? AND error_class IS NOT 'permanent')) "
+                "ORDER BY status = 'failed', position LIMIT ?",
+                (self.name, now, max_attempts, count)
+            ).fetchall()
+            self._db.executemany(
+                "UPDATE jobs SET status = 'leased', node = ?, lease_expires = ? "
+                "WHERE queue = ? AND url = ?",
+                [(self.node, now + self.lease_time, self.name, row[0]) for row in rows]
+            )
+        videos = []
+        for url, title, position, status, attempts, error_class, partial in rows:
+            if status == 'leased':
+                metrics.inc('ytdl_lease_expired_total')
+            videos.append({
+                'url': url, 'title': title or url, 'position': position, 'status': status,
+                'attempts': attempts, 'error_class': error_class,
+                'partial': json.loads(partial) if partial else None
+            })
+        return videos
+
+    def heartbeat(self):
+        """为本节点持有的所有租约续约，返回续约的视频数"""
+        expires = time.time() + self.lease_time
+        with self._transaction():
+            cursor = self._db.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE queue = ? AND node = ? AND status = 'leased'",
+                (expires, self.name, self.node)
+            )
+            self._db.execute("UPDATE queues SET lease_expires = ? WHERE name = ? AND node = ?",
+                             (expires, self.name, self.node))
+        return cursor.rowcount
+
+    def complete(self, url, changes):
+        """提交下载结果（_download_playlist_entry 返回的状态变化）并释放租约
+
+        租约已过期并被其他节点领取时不修改，返回 False。
+        """
+        values = {key: changes[key] for key in ('status', 'attempts', 'error_class', 'filename')
+                  if key in changes}
+        if 'partial' in changes:
+            values['partial'] = json.dumps(changes['partial']) if changes['partial'] else None
+        assignments = ''.join(f"{key} = ?, " for key in values)
+        with self._transaction():
+            cursor = self._db.execute(
+                f"UPDATE jobs SET {assignments}node = NULL, lease_expires = NULL "
+                "WHERE queue = ? AND url = ? AND node = ? AND status = 'leased'",
+                (*values.values(), self.name, url, self.node)
+            )
+        return cursor.rowcount == 1
+
+    def counts(self):
+        """按状态统计视频数"""
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs WHERE queue = ? GROUP BY status",
+                                    (self.name,)).fetchall()
+        return dict(rows)
+
+    def unfinished(self, max_attempts=3):
+        """还没有最终结果的视频数（包括其他节点正在下载的）"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE queue = ? AND (status IN ('pending', 'leased') "
+                "OR (status = 'failed' AND attempts < ? AND error_class IS NOT 'permanent'))",
+                (self.name, max_attempts)
+            ).fetchone()
+        return row[0]
+
+def _download_playlist_entry(video, format_id, output_path, stop_event, get_session, cache,
+                             postprocess=None, reporter=None):
+    """在工作线程中下载播放列表的单个视频，返回需要记录的状态变化
+
+    传入 postprocess 时，下载完成的文件交给它处理，返回值中的 'postprocess'
+    为后期处理的 Future。进度交给 reporter 汇总显示。
+    """
+    label = threading.current_thread().name
+    hook = make_worker_progress_hook(label, stop_event, reporter)
+    session = get_session()
+    try:
+        if session.rate_limiter is not None:
+            with metrics.timer('rate_limit_wait'):
+                session.rate_limiter.acquire(stop_event)
+        result = download_video(video['url'], format_id, output_path,
+                                progress_hooks=[hook], session=session, cache=cache)
+        if result == 0:
+            print(f"[{label}] 视频下载成功: {video['title']}")
+            if session.rate_limiter is not None:
+                session.rate_limiter.on_success()
+            changes = {'status': 'completed', 'filename': session.filepath, 'partial': None,
+                       'error_class': None}
+            reservation, session.reservation = session.reservation, None
+            try:
+                if postprocess is not None and session.downloads:
+                    future = postprocess.submit(session.downloads, stop_event)
+                    if reservation is not None:
+                        # 后期处理完成（或被取消）后才释放预留的磁盘空间
+                        future.add_done_callback(lambda _, held=reservation: held.close())
+                        reservation = None
+                    changes['postprocess'] = future
+                else:
+                    metrics.inc('ytdl_videos_total', result='completed')
+            finally:
+                if reservation is not None:
+                    reservation.close()
+            return changes
+        print(f"[{label}] 视频下载可能有问题: {video['title']}")
+    except yt_dlp.utils.DownloadCancelled:
+        # 被中断的视频保持待下载状态，下次从已下载的部分继续
+        metrics.inc('ytdl_videos_total', result='cancelled')
+        return {'status': 'pending', 'partial': session.partial}
+    except Exception as e:
+        print(f"[{label}] 视频下载失败: {video['title']}")
+        print(f"[{label}] 错误: {str(e)}")
+    metrics.inc('ytdl_videos_total', result='failed')
+    return {
+        'status': 'failed',
+        'attempts': video.get('attempts', 0) + 1,
+        'partial': session.partial,
+        # 'permanent' 的视频以后不再尝试
+        'error_class': session.error_class or 'transient'
+    }
+
+def _postprocess_result(video, future):
+    """根据后期处理的结果返回需要记录的状态变化"""
+    try:
+        filename = future.result()
+    except Exception as e:
+        print(f"后期处理失败: {video['title']}")
+        print(f"错误: {str(e)}")
+        metrics.inc('ytdl_failures_total', stage='postprocess', error=classify_error(e))
+        metrics.inc('ytdl_videos_total', result='failed')
+        return {'status': 'failed', 'attempts': video.get('attempts', 0) + 1}
+    print(f"后期处理完成: {video['title']}")
+    metrics.inc('ytdl_videos_total', result='completed')
+    return {'status': 'completed', 'filename': filename, 'partial': None, 'error_class': None}
+
+def _output_exists(video):
+    """已完成的视频文件是否还在磁盘上；旧的状态文件没有记录文件名时以状态为准"""
+    filename = video.get('filename')
+    return not filename or os.path.exists(filename)
+
+def download_playlist(playlist_info, format_id, output_path, start_from=0, workers=1, session=None,
+                      cache=None, max_attempts=3, postprocess_workers=None, rate_limiter=None,
+                      state_path="download_state.json", download_subs=True, progress='line',
+                      time_budget=AUTO_TIME_BUDGET, fragments=FRAGMENT_CONCURRENCY,
+                      max_connections=MAX_CONNECTIONS, index=None, expand=None, subtitles=None,
+                      scratch_path=None, min_free=DISK_RESERVE):
+    """下载播放列表中的视频，全部成功时返回 True
+
+    workers 个工作线程同时下载，每个线程复用一个 DownloadSession（逐个下载时可以
+    传入调用方的 session）。视频状态由 StateJournal 保存在 state_path 中：重新运行时
+    跳过已完成的视频，失败的最多尝试 max_attempts 次；按 Ctrl-C 时保存状态并返回 False。
+    expand 为产生 (cursor, video) 的迭代器（见 expand_sources）时边展开边下载，
+    展开失败时返回 False，下次从记录的位置继续展开。
+    其余参数见 MetadataCache（cache）、DownloadIndex（index）、PostprocessStage
+    （postprocess_workers，为 0 时不使用）、RateLimiter、ProgressReporter（progress）、
+    SubtitleStage（subtitles）、limit_connections 和 make_disk_budget。
+    """
+    if not playlist_info or not (playlist_info.get('videos') or expand is not None):
         print("错误: 播放列表信息无效")
         return False
     
     videos = playlist_info['videos']
-    total_videos = len(videos)
+    workers, fragments = limit_connections(workers, fragments, max_connections)
+    
+    # 继续下载时传入的是之前保存的状态，字段名带有 playlist_ 前缀
+    playlist_id = playlist_info.get('id', playlist_info.get('playlist_id', ''))
+    playlist_title = playlist_info.get('title', playlist_info.get('playlist_title', 'Unknown Playlist'))
     
-    print(f"\n开始下载播放列表: {playlist_info['title']}")
-    print(f"共有 {total_videos} 个视频，从第 {start_from + 1} 个开始下载")
+    def total():
+        # 仍在展开时总数未知，显示为“已知数量+”
+        return f"{len(videos)}+" if expand is not None else f"{len(videos)}"
+    
+    print(f"\n开始下载播放列表: {playlist_title}")
+    if expand is not None:
+        print(f"已知 {len(videos)} 个视频，其余视频边展开边下载")
+    else:
+        print(f"共有 {len(videos)} 个视频，从第 {start_from + 1} 个开始下载")
+    if workers > 1:
+        print(f"并发下载数: {workers}")
+    if fragments > 1:
+        print(f"每个视频同时下载的分片数: {fragments}")
     
     # 创建下载状态记录
     download_state = {
-        'playlist_id': playlist_info['id'],
-        'playlist_title': playlist_info['title'],
+        'playlist_id': playlist_id,
+        'playlist_title': playlist_title,
         'format_id': format_id,
         'output_path': output_path,
-        'total_videos': total_videos,
+        'workers': workers,
+        'total_videos': len(videos),
         'videos': videos
     }
+    # 展开的来源和进度，中断后从 expanded 处继续展开；日志的代数沿用上次的状态，
+    # 否则旧日志的代数可能与新快照相同而被重复重放
+    for key in ('sources', 'expanded', 'journal_generation'):
+        if key in playlist_info:
+            download_state[key] = playlist_info[key]
+    download_state['expansion_complete'] = expand is None
+    journal = StateJournal(download_state, state_path)
     
     # 初始化计数器
     success_count = 0
     failed_count = 0
+    reused_count = 0
     
-    # 下载视频
-    for i, video in enumerate(videos[start_from:], start_from):
-        video_url = video['url']
-        video_title = video['title']
-        
-        print(f"\n[{i+1}/{total_videos}] 正在下载: {video_title}")
+    # 根据每个视频的状态安排下载：先待下载，再重试失败的视频
+    pending = collections.deque()
+    retry = collections.deque()
+    
+    def schedule(i):
+        nonlocal success_count, failed_count, reused_count
+        video = videos[i]
+        status = video.get('status')
+        if status == 'completed' and _output_exists(video):
+            success_count += 1
+            return
+        if status == 'failed' and video.get('attempts', 0) >= max_attempts:
+            print(f"[{i+1}/{total()}] 已失败 {video['attempts']} 次，跳过: {video['title']}")
+            failed_count += 1
+            return
+        if status == 'failed' and video.get('error_class') == 'permanent':
+            print(f"[{i+1}/{total()}] 视频无法下载（私有、已删除或受地区限制），跳过: {video['title']}")
+            failed_count += 1
+            return
         
-        # 检查视频状态
-        if video.get('status') == 'completed':
-            print(f"视频已下载，跳过")
+        # 以前下载过同一视频和格式时直接使用已有文件
+        existing = index.lookup(video['url'], format_id) if index is not None else None
+        if existing:
+            journal.record(i, status='completed', filename=index.link(existing, output_path),
+                           partial=None)
             success_count += 1
-            continue
+            reused_count += 1
+            return
+        
+        if status == 'completed':
+            print(f"[{i+1}/{total()}] 文件已不存在，重新下载: {video['title']}")
+            pending.append(i)
+        elif status == 'failed':
+            retry.append(i)
+        else:
+            pending.append(i)
         
+        partial = video.get('partial')
+        if partial and partial.get('tmpfilename') and os.path.exists(partial['tmpfilename']):
+            print(f"[{i+1}/{total()}] 将从第 {os.path.getsize(partial['tmpfilename'])} 字节继续: "
+                  f"{video['title']}")
+    
+    for i in range(start_from, len(videos)):
+        schedule(i)
+    
+    if reused_count:
+        print(f"{reused_count} 个视频以前已经下载过，使用已有文件")
+    if success_count > reused_count:
+        print(f"已下载 {success_count - reused_count} 个视频，跳过")
+    print(f"待下载 {len(pending)} 个，重试 {len(retry)} 个")
+    if retry:
+        metrics.inc('ytdl_retries_total', len(retry), kind='playlist')
+    
+    # 展开在单独的线程中进行，每次取一个视频，待下载的视频不足 2 × workers 个时才继续，
+    # 因此内存中只保留少量尚未安排的条目
+    known_urls = {video['url'] for video in videos}
+    expander = ThreadPoolExecutor(max_workers=1, thread_name_prefix='expand') if expand is not None else None
+    expanding = None
+    expand_failures = 0
+    expansion_error = None
+    
+    def retry_expansion(attempt):
+        # 出错的生成器不能继续使用，等待后从最后记录的位置重新展开
+        time.sleep(retry_delay(attempt))
+        yield from expand_sources(download_state['sources'], download_state.get('expanded'))
+    
+    def on_expanded(future):
+        nonlocal expand, expand_failures, expansion_error
         try:
-            result = download_video(video_url, format_id, output_path)
-            if result == 0:
-                print(f"视频下载成功: {video_title}")
-                videos[i]['status'] = 'completed'
-                success_count += 1
+            item = future.result()
+        except Exception as e:
+            expand_failures += 1
+            print(f"展开播放列表出错 (第 {expand_failures}/{EXPAND_ATTEMPTS} 次): {str(e)}")
+            metrics.inc('ytdl_failures_total', stage='expand', error=classify_error(e))
+            if expand_failures < EXPAND_ATTEMPTS and download_state.get('sources'):
+                expand = retry_expansion(expand_failures)
+                return
+            # 展开没有完成，下次运行时从记录的位置继续
+            print("不再展开播放列表，只下载已展开的视频")
+            expansion_error = str(e)
+            journal.record(None, expansion_error=expansion_error)
+            expand = None
+            return
+        if item is None:
+            journal.record(None, expansion_complete=True)
+            print(f"播放列表展开完成，共 {len(videos)} 个视频")
+            expand = None
+            return
+        expand_failures = 0
+        cursor, video = item
+        if video['url'] in known_urls:
+            journal.record(None, expanded=cursor)
+            return
+        known_urls.add(video['url'])
+        journal.append(video, expanded=cursor, total_videos=len(videos) + 1)
+        schedule(len(videos) - 1)
+    
+    if is_audio_only(format_id):
+        # 仅音频的下载不获取字幕
+        download_subs = False
+    owns_subtitles = download_subs and subtitles is None
+    if owns_subtitles:
+        subtitles = SubtitleStage()
+    elif not download_subs:
+        subtitles = None
+    
+    # 有ffmpeg时把后期处理交给单独的线程池，下载线程不等待ffmpeg
+    postprocess = None
+    if postprocess_workers != 0 and ffmpeg_available():
+        postprocess = PostprocessStage(postprocess_workers, subtitles=subtitles)
+        print(f"后期处理线程数: {postprocess.workers}")
+    
+    if rate_limiter is None:
+        rate_limiter = RateLimiter()
+    
+    reporter = ProgressReporter(progress) if progress else None
+    throughput = ThroughputEstimator()
+    stop_event = threading.Event()
+    disk_budget = make_disk_budget(output_path, scratch_path, min_free, stop_event)
+    # 每个工作线程一个会话，播放列表结束后统一关闭
+    sessions = SessionPool(download_subs=download_subs, defer_postprocessing=postprocess is not None,
+                           rate_limiter=rate_limiter, throughput=throughput, time_budget=time_budget,
+                           fragments=fragments, subtitles=subtitles, disk_budget=disk_budget,
+                           scratch_path=scratch_path)
+    
+    def get_session():
+        if workers == 1 and session is not None and postprocess is None:
+            session.rate_limiter = session.ydl.rate_limiter = rate_limiter
+            session.disk_budget = disk_budget
+            session.scratch_path = scratch_path
+            session.time_budget = time_budget
+            session.ydl.params['concurrent_fragment_downloads'] = fragments
+            return session
+        return sessions.get()
+    
+    running = {}
+    processing = {}
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='worker')
+    
+    def record(i, changes):
+        nonlocal success_count, failed_count
+        if changes['status'] == 'completed':
+            success_count += 1
+            if index is not None:
+                index.add(videos[i]['url'], format_id, changes.get('filename'))
+        elif changes['status'] == 'failed':
+            failed_count += 1
+        journal.record(i, **changes)
+    
+    try:
+        while True:
+            # 待下载的视频不足时展开下一个条目
+            if expand is not None and expanding is None and len(pending) + len(retry) < workers * 2:
+                expanding = expander.submit(next, expand, None)
+            
+            # 填满工作线程
+            while (pending or retry) and len(running) < workers:
+                i = pending.popleft() if pending else retry.popleft()
+                print(f"\n[{i+1}/{total()}] 正在下载: {videos[i]['title']}")
+                future = executor.submit(
+                    _download_playlist_entry, videos[i], format_id, output_path,
+                    stop_event, get_session, cache, postprocess, reporter
+                )
+                running[future] = i
+            
+            waiting = list(running) + list(processing) + ([expanding] if expanding else [])
+            if not waiting:
+                break
+            done, _ = wait(waiting, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future is expanding:
+                    expanding = None
+                    on_expanded(future)
+                    continue
+                
+                if future in processing:
+                    i = processing.pop(future)
+                    record(i, _postprocess_result(videos[i], future))
+                    continue
+                
+                i = running.pop(future)
+                changes = future.result()
+                if 'postprocess' in changes:
+                    # 下载完成，等待后期处理结束后再记为完成
+                    processing[changes.pop('postprocess')] = i
+                else:
+                    # 记录当前下载状态
+                    record(i, changes)
+    except KeyboardInterrupt:
+        print("\n用户中断，正在停止下载...")
+        stop_event.set()
+        if expander is not None:
+            # 正在获取的页面不再等待，下次从已记录的位置继续展开
+            expander.shutdown(wait=False, cancel_futures=True)
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future, i in running.items():
+            if future.cancelled() or future.exception() is not None:
+                continue
+            changes = future.result()
+            if 'postprocess' in changes:
+                processing[changes.pop('postprocess')] = i
             else:
-                print(f"视频下载可能有问题: {video_title}")
-                videos[i]['status'] = 'failed'
-                failed_count += 1
+                record(i, changes)
+        if postprocess is not None:
+            # 正在运行的ffmpeg任务会完成，排队中的任务被取消，下次重新下载
+            postprocess.close(cancel=True)
+            for future, i in processing.items():
+                if not future.cancelled():
+                    record(i, _postprocess_result(videos[i], future))
+        journal.close()
+        print(f"下载状态已保存到 {state_path}")
+        print(f"成功: {success_count}, 失败: {failed_count}, 总计: {total()}")
+        print("可重新运行程序继续下载")
+        return False
+    finally:
+        executor.shutdown(wait=False)
+        if expander is not None:
+            expander.shutdown(wait=False)
+        if postprocess is not None:
+            postprocess.close()
+        sessions.close()
+        if owns_subtitles:
+            subtitles.close()
+        journal.close()
+        if reporter is not None:
+            reporter.close()
+    
+    # 打印下载汇总
+    print("\n下载完成！")
+    print(f"成功: {success_count}, 失败: {failed_count}, 总计: {len(videos)}")
+    if expansion_error is not None:
+        print(f"警告: 播放列表没有展开完成 ({expansion_error})，重新运行时继续展开")
+    stats = rate_limiter.stats()
+    print(f"限速: 当前每 {stats['window']} 秒 {stats['rate']:.1f} 个视频，退避 {stats['backoffs']} 次")
+    
+    return success_count == len(videos) and expansion_error is None
+
+def download_distributed(urls, queue_path, format_id=None, preset=None, output_path=None,
+                         concurrency=1, queue_name=None, lease_time=120, poll_interval=5,
+                         download_subs=True, max_attempts=3, progress='line',
+                         time_budget=AUTO_TIME_BUDGET, fragments=FRAGMENT_CONCURRENCY,
+                         max_connections=MAX_CONNECTIONS, index_path="download_index.sqlite",
+                         hash_files=False, sub_langs=None, scratch_path=None, min_free=DISK_RESERVE):
+    """作为一个节点参与多机下载，视频从共享的 JobQueue 中领取
+
+    每个节点用相同的URL和格式运行，queue_path 为所有节点都能访问的队列文件，
+    output_path 通常也是共享目录。queue_name 默认由URL和格式生成，相同的一批URL
+    对应同一个队列。一个节点负责展开播放列表，所有节点同时领取已展开的视频，
+    每个节点同时下载 concurrency 个，节点越多总吞吐量越高。
+
+    各视频的状态保存在队列中，与下载状态文件的规则相同：已完成的不再下载，
+    失败的最多尝试 max_attempts 次，永久错误不再尝试。节点中断时正在下载的视频
+    立即交还队列；节点崩溃时在租约（lease_time 秒）过期后由其他节点继续。
+    展开播放列表连续失败 EXPAND_ATTEMPTS 次后放弃展开，只下载已展开的视频，返回 False。
+    队列中所有视频都有结果后返回，全部成功时返回 True。
+    scratch_path 和 min_free 见 make_disk_budget。
+    """
+    if format_id is None:
+        format_id = PRESET_FORMATS[preset or 'best']
+    download_subs = download_subs and not is_audio_only(format_id)
+    sources = list(urls)
+    if queue_name is None:
+        key = json.dumps([sources, format_id], ensure_ascii=False).encode('utf-8')
+        queue_name = hashlib.sha1(key).hexdigest()[:16]
+    workers, fragments = limit_connections(concurrency, fragments, max_connections)
+    
+    queue = JobQueue(queue_path, queue_name, lease_time=lease_time)
+    print(f"\n分布式下载: 队列 {queue_name}，节点 {queue.node}")
+    if workers > 1:
+        print(f"并发下载数: {workers}")
+    
+    stop_event = threading.Event()
+    
+    def heartbeat():
+        while not stop_event.wait(lease_time / 3):
+            try:
+                queue.heartbeat()
+            except sqlite3.Error as e:
+                print(f"\n租约续约失败: {str(e)}")
+    
+    expand_failures = 0
+    
+    def expand():
+        # 只有领取到展开租约的节点展开，其余节点只下载
+        nonlocal expand_failures
+        claimed, cursor = queue.claim_expansion()
+        if not claimed:
+            return
+        try:
+            for cursor, video in expand_sources(sources, cursor):
+                if stop_event.is_set() or not queue.add(video, cursor):
+                    return
+            queue.finish_expansion()
+            print("\n播放列表展开完成")
         except Exception as e:
-            print(f"视频下载失败: {video_title}")
-            print(f"错误: {str(e)}")
-            videos[i]['status'] = 'failed'
+            expand_failures += 1
+            print(f"展开播放列表出错 (第 {expand_failures}/{EXPAND_ATTEMPTS} 次): {str(e)}")
+            metrics.inc('ytdl_failures_total', stage='expand', error=classify_error(e))
+            # 不交还租约的话心跳会一直续约，其他节点无法接手，也永远不会展开完成
+            if expand_failures >= EXPAND_ATTEMPTS:
+                print("不再展开播放列表，只下载已展开的视频")
+                queue.abandon_expansion(str(e))
+            else:
+                queue.release_expansion()
+    
+    rate_limiter = RateLimiter()
+    reporter = ProgressReporter(progress) if progress else None
+    throughput = ThroughputEstimator()
+    disk_budget = make_disk_budget(output_path, scratch_path, min_free, stop_event)
+    subtitles = SubtitleStage(sub_langs) if download_subs else None
+    sessions = SessionPool(download_subs=download_subs, rate_limiter=rate_limiter,
+                           throughput=throughput, time_budget=time_budget, fragments=fragments,
+                           subtitles=subtitles, disk_budget=disk_budget, scratch_path=scratch_path)
+    
+    success_count = 0
+    failed_count = 0
+    
+    def record(video, changes):
+        nonlocal success_count, failed_count
+        if not queue.complete(video['url'], changes):
+            print(f"租约已过期，结果以其他节点为准: {video['title']}")
+            return
+        if changes['status'] == 'completed':
+            success_count += 1
+            if index is not None:
+                index.add(video['url'], format_id, changes.get('filename'))
+        elif changes['status'] == 'failed':
             failed_count += 1
+    
+    index = DownloadIndex(index_path, hash_files) if index_path else None
+    cache = MetadataCache()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='worker')
+    threading.Thread(target=heartbeat, name='heartbeat', daemon=True).start()
+    expander = threading.Thread(target=expand, name='expand', daemon=True)
+    expander.start()
+    running = {}
+    try:
+        while True:
+            if len(running) < workers:
+                for video in queue.lease(workers - len(running), max_attempts):
+                    existing = index.lookup(video['url'], format_id) if index is not None else None
+                    if existing:
+                        record(video, {'status': 'completed', 'partial': None,
+                                       'filename': index.link(existing, output_path)})
+                        continue
+                    retrying = "重试" if video['status'] == 'failed' else "正在下载"
+                    print(f"\n[{video['position'] + 1}] {retrying}: {video['title']}")
+                    future = executor.submit(
+                        _download_playlist_entry, video, format_id, output_path,
+                        stop_event, sessions.get, cache, None, reporter
+                    )
+                    running[future] = video
+            
+            if not running:
+                if queue.expansion_complete() and not queue.unfinished(max_attempts):
+                    break
+                # 等待展开或其他节点的租约；展开节点退出后由本节点接着展开
+                if not expander.is_alive() and not queue.expansion_complete():
+                    expander = threading.Thread(target=expand, name='expand', daemon=True)
+                    expander.start()
+                time.sleep(poll_interval)
+                continue
+            
+            done, _ = wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                record(running.pop(future), future.result())
+    except KeyboardInterrupt:
+        print("\n用户中断，正在停止下载...")
+        stop_event.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        for future, video in running.items():
+            if future.cancelled() or future.exception() is not None:
+                # 交还租约，其他节点可以立即领取
+                record(video, {'status': 'pending'})
+            else:
+                record(video, future.result())
+        print(f"本节点成功: {success_count}, 失败: {failed_count}")
+        print("未完成的视频已交还队列，可重新运行程序继续下载")
+        return False
+    finally:
+        stop_event.set()
+        executor.shutdown(wait=False)
+        sessions.close()
+        if subtitles is not None:
+            subtitles.close()
+        if reporter is not None:
+            reporter.close()
+        cache.close()
+        if index is not None:
+            index.close()
+        counts = queue.counts()
+        expansion_error = queue.expansion_error()
+        queue.close()
+    
+    print("\n下载完成！")
+    print(f"本节点成功: {success_count}, 失败: {failed_count}")
+    print(f"所有节点: 成功 {counts.get('completed', 0)}, 失败 {counts.get('failed', 0)}, "
+          f"总计 {sum(counts.values())}")
+    if expansion_error:
+        print(f"警告: 播放列表没有完全展开: {expansion_error}")
+    return not counts.get('failed') and not expansion_error
+
+class AsyncDownloader:
+    """供异步服务嵌入的下载调度器
+
+    yt-dlp 的调用都是阻塞的，这里把它们放到线程池中运行，每个线程复用自己的
+    DownloadSession。任务按 priority 从小到大调度，同时最多运行 concurrency 个，
+    同一主机最多 per_host 个。超时或取消等待中的任务时，正在进行的下载会在
+    下一次进度回调时中断，部分下载的文件保留，下次从断点继续。
+
+        async with AsyncDownloader(concurrency=4) as downloader:
+            result = await downloader.download(url, priority=1, timeout=600)
+
+    结果与 download_playlist 记录的状态相同：status 为 'completed'、'failed'、
+    'pending'（被取消）或 'timeout'，另外包含 'url' 和 'filename' 等字段。
+    concurrency × fragments 不超过 max_connections，见 limit_connections。
+    """
+
+    def __init__(self, concurrency=4, per_host=2, format_id=None, output_path=None,
+                 download_subs=True, timeout=None, rate_limiter=None, cache=None,
+                 fragments=FRAGMENT_CONCURRENCY, max_connections=MAX_CONNECTIONS):
+        concurrency, fragments = limit_connections(concurrency, fragments, max_connections)
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.format_id = format_id or PRESET_FORMATS['best']
+        self.output_path = output_path
+        self.download_subs = download_subs
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.cache = cache
+        self.fragments = fragments
+        # 所有线程的会话共用一个字幕线程池和字幕缓存
+        self.subtitles = SubtitleStage() if download_subs else None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency + 1, thread_name_prefix='async')
+        self._throughput = ThroughputEstimator()
+        self._sessions = SessionPool(download_subs=download_subs, rate_limiter=self.rate_limiter,
+                                     throughput=self._throughput, fragments=fragments,
+                                     subtitles=self.subtitles)
+        self._queue = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._host_running = collections.Counter()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _dispatch(self):
+        """按优先级启动可以运行的任务，所在主机已满的任务留在队列中"""
+        blocked = []
+        while self._queue and self._running < self.concurrency:
+            item = heapq.heappop(self._queue)
+            host, started = item[2], item[3]
+            if started.done():
+                # 等待中已被取消或超时
+                continue
+            if self._host_running[host] >= self.per_host:
+                blocked.append(item)
+                continue
+            self._running += 1
+            self._host_running[host] += 1
+            started.set_result(None)
+        for item in blocked:
+            heapq.heappush(self._queue, item)
+
+    def _release(self, host):
+        self._running -= 1
+        self._host_running[host] -= 1
+        if not self._host_running[host]:
+            del self._host_running[host]
+        self._dispatch()
+
+    async def download(self, url, priority=0, format_id=None, timeout=None, title=None):
+        """下载一个视频并返回结果；priority 越小越先开始，timeout 包括排队时间"""
+        loop = asyncio.get_running_loop()
+        host = urllib.parse.urlparse(url).hostname or ''
+        started = loop.create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), host, started))
+        self._dispatch()
+
+        video = {'url': url, 'title': title or url}
+        stop_event = threading.Event()
+        timeout = self.timeout if timeout is None else timeout
+        deadline = None if timeout is None else loop.time() + timeout
+        try:
+            await asyncio.wait_for(asyncio.shield(started), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if not started.done():
+                started.cancel()
+            elif not started.cancelled():
+                # 超时的同时刚好轮到这个任务
+                self._release(host)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return dict(video, status='timeout')
+
+        running = loop.run_in_executor(
+            self._executor, _download_playlist_entry, video, format_id or self.format_id,
+            self.output_path, stop_event, self._sessions.get, self.cache
+        )
+        try:
+            remaining = None if deadline is None else max(0, deadline - loop.time())
+            changes = await asyncio.wait_for(asyncio.shield(running), remaining)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # 通知下载线程停止，等它退出后再释放位置
+            stop_event.set()
+            await asyncio.wait([running])
+            if isinstance(e, asyncio.CancelledError):
+                self._release(host)
+                raise
+            changes = dict(running.result(), status='timeout')
+        self._release(host)
+        return dict(video, **changes)
+
+    async def download_many(self, urls, priority=0, timeout=None):
+        """并发下载多个URL，按输入顺序返回结果"""
+        return await asyncio.gather(*(self.download(url, priority, timeout=timeout) for url in urls))
+
+    async def extract_info(self, url, cache_max_age=None):
+        """在线程池中提取视频信息（不下载），有 cache 时先查缓存"""
+        def extract():
+            if self.cache is not None:
+                info = self.cache.get('video', url, cache_max_age or self.cache.format_ttl)
+                if info is not None:
+                    return info
+            info = self._sessions.get().extract_info(url, ignoreerrors=False)
+            if self.cache is not None and info:
+                self.cache.put('video', url, info)
+            return info
+        return await asyncio.get_running_loop().run_in_executor(self._executor, extract)
+
+    async def close(self):
+        """等待线程池中的任务结束并关闭所有会话"""
+        await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown, True)
+        self._sessions.close()
+        if self.subtitles is not None:
+            self.subtitles.close()
+
+def print_cache_stats(cache):
+    """打印信息缓存的命中情况"""
+    stats = cache.stats()
+    print(f"信息缓存: 命中 {stats['hits']}, 未命中 {stats['misses']}, 过期 {stats['stale']}, "
+          f"淘汰 {stats['evictions']}, 共 {stats['entries']} 条 ({stats['bytes'] // 1024} KiB)")
+
+def _is_playlist_url(url):
+    """根据URL判断是否是播放列表"""
+    return "playlist" in url or "list=" in url
+
+def download_batch(urls, format_id=None, preset=None, output_path=None, concurrency=1,
+                   state_path="download_state.json", download_subs=True, max_attempts=3,
+                   progress='line', time_budget=AUTO_TIME_BUDGET, fragments=FRAGMENT_CONCURRENCY,
+                   max_connections=MAX_CONNECTIONS, index_path="download_index.sqlite",
+                   hash_files=False, sub_langs=None, scratch_path=None, min_free=DISK_RESERVE):
+    """批量下载多个视频或播放列表，不读取标准输入
+
+    播放列表由 expand_sources 逐页展开，与单个视频合并成一个任务列表，
+    一边展开一边交给 download_playlist 下载。用相同的URL重新运行时沿用
+    state_path 中的状态并从上次展开到的位置继续；URL不同时已有的视频状态按URL合并，
+    因此只会补齐未完成的视频。
+
+    format_id 优先于 preset；两者都没有时使用 PRESET_FORMATS['best']。
+    progress 为进度输出方式，见 ProgressReporter。preset 为 'auto' 时每个视频
+    选择预计 time_budget 秒内能下载完的最佳格式。
+    index_path 为 DownloadIndex 的文件，以前下载过的视频直接使用已有文件，
+    为 None 时不使用索引。sub_langs 为字幕语言（默认 DEFAULT_SUB_LANGS），
+    获取过的字幕缓存在 subtitle_cache.sqlite 中。scratch_path 和 min_free
+    见 make_disk_budget。
+    全部视频下载成功时返回 True。
+    """
+    if format_id is None:
+        format_id = PRESET_FORMATS[preset or 'best']
+    download_subs = download_subs and not is_audio_only(format_id)
+    
+    sources = list(urls)
+    previous_state = load_download_state(state_path) if os.path.exists(state_path) else None
+    playlist_info = {'id': 'batch', 'title': f"批量下载 ({len(sources)} 个URL)", 'sources': sources}
+    if previous_state and 'journal_generation' in previous_state:
+        # 新状态会覆盖同一个文件，日志的代数继续递增
+        playlist_info['journal_generation'] = previous_state['journal_generation']
+    
+    if previous_state and previous_state.get('sources') == sources:
+        # 同一批URL：沿用已展开的视频，从上次展开到的位置继续
+        playlist_info['videos'] = previous_state.get('videos', [])
+        playlist_info['expanded'] = previous_state.get('expanded')
+        expand = None
+        if not previous_state.get('expansion_complete', True):
+            expand = expand_sources(sources, previous_state.get('expanded'))
+    else:
+        # 不同的URL：从头展开，已经出现在上次状态中的视频沿用其状态
+        previous = {v.get('url'): v for v in (previous_state or {}).get('videos', [])}
         
-        # 保存当前下载状态
-        save_download_state(download_state)
+        def merge_previous():
+            for cursor, video in expand_sources(sources):
+                old = previous.get(video['url'])
+                if old:
+                    for key in ('status', 'filename', 'attempts', 'partial', 'error_class'):
+                        if key in old:
+                            video[key] = old[key]
+                yield cursor, video
         
-        # 每5个视频暂停一下，避免被YouTube限制
-        if (i + 1) % 5 == 0 and i < total_videos - 1:
-            pause_time = 10
-            print(f"\n已下载 5 个视频，暂停 {pause_time} 秒避免被限制...")
-            time.sleep(pause_time)
+        playlist_info['videos'] = []
+        expand = merge_previous()
     
-    # 打印下载汇总
-    print("\n下载完成！")
-    print(f"成功: {success_count}, 失败: {failed_count}, 总计: {total_videos}")
+    subtitles = SubtitleStage(sub_langs) if download_subs else None
+    with DownloadSession(download_subs, subtitles=subtitles) as session, MetadataCache() as cache:
+        index = DownloadIndex(index_path, hash_files) if index_path else None
+        try:
+            return download_playlist(
+                playlist_info, format_id, output_path, workers=concurrency, session=session,
+                cache=cache, max_attempts=max_attempts, state_path=state_path,
+                download_subs=download_subs, progress=progress, time_budget=time_budget,
+                fragments=fragments, max_connections=max_connections, index=index, expand=expand,
+                subtitles=subtitles, scratch_path=scratch_path, min_free=min_free
+            )
+        finally:
+            if index is not None:
+                index.close()
+            if subtitles is not None:
+                subtitles.close()
+
+# 更新字幕时处理的视频文件类型
+VIDEO_EXTS = ('mp4', 'mkv', 'webm', 'mov', 'm4a')
+
+def refresh_subtitles(paths, sub_langs=None):
+    """只更新已下载视频中的字幕，不重新下载视频
+
+    paths 为视频文件或目录（不包括子目录）。视频ID取自文件名末尾的 [ID]
+    （见 _output_template），重新获取字幕后只复制流，在一次ffmpeg运行中替换
+    原有的字幕轨。各视频的字幕并行获取。返回更新的文件数。
+    """
+    if not ffmpeg_available():
+        print("错误: 更新字幕需要ffmpeg")
+        return 0
+    
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if name.rsplit('.', 1)[-1].lower() in VIDEO_EXTS)
+        else:
+            files.append(path)
+    
+    updated = 0
+    with SubtitleCache() as cache, DownloadSession(download_subs=False) as session:
+        subtitles = SubtitleStage(sub_langs, cache, refresh=True)
+        pp = _ytdl_classes()['RemuxOrConvertPP'](session.ydl, subtitles=subtitles)
+        try:
+            # 先提取所有视频的信息并开始获取字幕，再逐个嵌入
+            jobs = []
+            for filepath in files:
+                match = re.search(r'\[([\w-]+)\]\.\w+$', filepath)
+                if not match:
+                    print(f"文件名中没有视频ID，跳过: {filepath}")
+                    continue
+                info = session.resolve(f"https://www.youtube.com/watch?v={match.group(1)}")
+                if not info:
+                    print(f"无法获取视频信息，跳过: {filepath}")
+                    continue
+                subtitles.submit(session.ydl, info)
+                jobs.append((filepath, info))
+            
+            for filepath, info in jobs:
+                tracks = subtitles.collect(session.ydl, info)
+                if not tracks:
+                    print(f"没有可用的字幕: {filepath}")
+                    continue
+                ext = filepath.rsplit('.', 1)[-1].lower()
+                files_to_delete, _ = pp.embed({'id': info['id'], 'filepath': filepath, 'ext': ext}, tracks)
+                for filename in files_to_delete:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                updated += 1
+                print(f"已更新 {len(tracks)} 个字幕: {filepath}")
+        finally:
+            subtitles.close()
+    return updated
+
+def _read_batch_file(filename):
+    """读取URL列表文件：每行一个URL，忽略空行和以 # 开头的注释"""
+    with open(filename, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+
+def batch_main(argv):
+    """批量模式入口：所有参数来自命令行，不进行任何交互"""
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]),
+        description="批量下载YouTube视频或播放列表（非交互模式）"
+    )
+    parser.add_argument('urls', nargs='*', help="视频或播放列表URL")
+    parser.add_argument('-a', '--batch-file', help="URL列表文件，每行一个URL")
+    parser.add_argument('-o', '--output', help="下载路径（默认当前目录）")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-f', '--format', help="yt-dlp格式字符串，例如 bestvideo+bestaudio/best")
+    group.add_argument('-p', '--preset', choices=list(PRESET_FORMATS),
+                       help="预设格式（默认 best），auto 按实测下载速度选择")
+    group.add_argument('-x', '--audio', action='store_true',
+                       help="仅下载音频：最佳音频格式，不转码、不获取字幕，默认并发数为 --max-connections")
+    parser.add_argument('-j', '--concurrency', type=int,
+                        help="同时下载的视频数量（默认1，--audio 时为 --max-connections）")
+    parser.add_argument('-N', '--fragments', type=int, default=FRAGMENT_CONCURRENCY,
+                        help=f"分片格式每个视频同时下载的分片数（默认{FRAGMENT_CONCURRENCY}）")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help=f"所有下载同时打开的连接数上限（默认{MAX_CONNECTIONS}）")
+    parser.add_argument('--state', default="download_state.json", help="下载状态文件（默认 download_state.json）")
+    parser.add_argument('--time-budget', type=int, default=AUTO_TIME_BUDGET,
+                        help=f"--preset auto 时每个视频允许的下载时间，秒（默认{AUTO_TIME_BUDGET}）")
+    parser.add_argument('--index', default="download_index.sqlite",
+                        help="已完成下载的索引文件（默认 download_index.sqlite）")
+    parser.add_argument('--no-index', action='store_true', help="不使用下载索引，总是重新下载")
+    parser.add_argument('--hash-files', action='store_true',
+                        help="记录文件的SHA-256，内容相同的文件合并为硬链接")
+    parser.add_argument('--max-attempts', type=int, default=3, help="每个视频的最多尝试次数（默认3）")
+    parser.add_argument('--scratch', help="未完成文件的临时目录（例如更快的本地磁盘），完成后移动到下载路径")
+    parser.add_argument('--min-free', type=int, default=DISK_RESERVE // (1024 * 1024),
+                        help="下载时至少保留的磁盘空间，MiB（默认不保留，只确认放得下正在下载的视频）")
+    parser.add_argument('--queue', help="多台机器共享的任务队列文件，指定后以分布式模式运行（不使用 --state）")
+    parser.add_argument('--queue-name', help="队列名称（默认由URL和格式生成）")
+    parser.add_argument('--lease-time', type=int, default=120,
+                        help="分布式模式下节点失去响应多少秒后其视频交给其他节点（默认120）")
+    parser.add_argument('--no-subs', action='store_true', help="不下载字幕")
+    parser.add_argument('--sub-langs', help=f"字幕语言，用逗号分隔（默认 {','.join(DEFAULT_SUB_LANGS)}）")
+    parser.add_argument('--refresh-subs', action='store_true',
+                        help="只更新参数中视频文件或目录里已下载视频的字幕，不重新下载视频")
+    parser.add_argument('--progress', choices=['line', 'json', 'none'], default='line',
+                        help="进度输出方式：line 为文字汇总，json 为写到 stderr 的 JSON 行（默认 line）")
+    parser.add_argument('--metrics-file', help="定期把 Prometheus 文本格式的指标写入此文件")
+    parser.add_argument('--metrics-port', type=int, help="在 127.0.0.1 的此端口上提供 /metrics")
+    parser.add_argument('--debug', action='store_true', help="打印调试信息")
+    args = parser.parse_args(argv)
     
-    return success_count == total_videos
+    if args.debug:
+        global DEBUG
+        DEBUG = True
+    
+    urls = list(args.urls)
+    if args.batch_file:
+        urls.extend(_read_batch_file(args.batch_file))
+    if not urls:
+        parser.error("请提供至少一个URL或使用 --batch-file")
+    sub_langs = args.sub_langs.split(',') if args.sub_langs else None
+    if args.audio:
+        # 音频文件小且不分片，用尽连接数上限同时下载
+        args.preset = 'audio'
+        args.no_subs = True
+    if args.concurrency is None:
+        args.concurrency = args.max_connections if args.audio else 1
+    if args.refresh_subs:
+        return 0 if refresh_subtitles(urls, sub_langs) else 1
+    
+    exporter = None
+    if args.metrics_file or args.metrics_port is not None:
+        exporter = MetricsExporter(args.metrics_file, args.metrics_port)
+    try:
+        if args.queue:
+            return 0 if download_distributed(
+                urls, args.queue, format_id=args.format, preset=args.preset,
+                output_path=args.output, concurrency=args.concurrency, queue_name=args.queue_name,
+                lease_time=args.lease_time, download_subs=not args.no_subs,
+                max_attempts=args.max_attempts,
+                progress=None if args.progress == 'none' else args.progress,
+                time_budget=args.time_budget, fragments=args.fragments,
+                max_connections=args.max_connections,
+                index_path=None if args.no_index else args.index, hash_files=args.hash_files,
+                sub_langs=sub_langs, scratch_path=args.scratch, min_free=args.min_free * 1024 * 1024
+            ) else 1
+        ok = download_batch(
+            urls, format_id=args.format, preset=args.preset, output_path=args.output,
+            concurrency=args.concurrency, state_path=args.state,
+            download_subs=not args.no_subs, max_attempts=args.max_attempts,
+            progress=None if args.progress == 'none' else args.progress,
+            time_budget=args.time_budget, fragments=args.fragments,
+            max_connections=args.max_connections,
+            index_path=None if args.no_index else args.index, hash_files=args.hash_files,
+            sub_langs=sub_langs, scratch_path=args.scratch, min_free=args.min_free * 1024 * 1024
+        )
+    finally:
+        if exporter is not None:
+            exporter.close()
+    return 0 if ok else 1
 
 def main():
+    # 带有选项参数时使用批量模式，否则保持原来的交互方式
+    if any(arg.startswith('-') for arg in sys.argv[1:]):
+        return batch_main(sys.argv[1:])
+    
     print_banner()
     
     # 检查是否有之前未完成的下载
@@ -308,24 +3419,23 @@ def main():
         
         resume_choice = input("是否继续上次的下载? (y/n): ")
         if resume_choice.lower() == 'y':
-            # 查找上次下载位置
-            start_from = 0
-            for i, video in enumerate(previous_state.get('videos', [])):
-                if video.get('status') == 'completed':
-                    start_from = i + 1
-            
-            # 如果所有视频都已下载，从头开始
-            if start_from >= len(previous_state.get('videos', [])):
-                print("所有视频都已下载完成，将重新开始")
-                start_from = 0
-            
-            # 继续下载
-            download_playlist(
-                previous_state,
-                previous_state.get('format_id'),
-                previous_state.get('output_path'),
-                start_from
-            )
+            # 继续下载：download_playlist 按每个视频的状态只补齐未完成的视频
+            # 上次没有展开完的播放列表从记录的位置继续展开
+            expand = None
+            if not previous_state.get('expansion_complete', True) and previous_state.get('sources'):
+                expand = expand_sources(previous_state['sources'], previous_state.get('expanded'))
+            with DownloadSession() as session, MetadataCache() as cache, DownloadIndex() as index:
+                download_playlist(
+                    previous_state,
+                    previous_state.get('format_id'),
+                    previous_state.get('output_path'),
+                    workers=previous_state.get('workers', 1),
+                    session=session,
+                    cache=cache,
+                    index=index,
+                    expand=expand
+                )
+                print_cache_stats(cache)
             return 0
     
     # 检查是否有URL参数
@@ -339,12 +3449,16 @@ def main():
     if len(sys.argv) > 2:
         output_path = sys.argv[2]
     
+    # 整个运行期间共用一个下载会话和信息缓存
+    session = DownloadSession()
+    cache = MetadataCache()
     try:
         # 检查是否是播放列表
-        is_playlist = "playlist" in url or "list=" in url
+        is_playlist = _is_playlist_url(url)
+        formats_info = None
         
         if is_playlist:
-            playlist_info = get_playlist_info(url)
+            playlist_info = get_playlist_info(url, session, cache)
             if not playlist_info:
                 print("无法获取播放列表信息，将尝试作为单个视频下载")
                 is_playlist = False
@@ -405,28 +3519,24 @@ def main():
             print("2. 最佳音频质量")
             print("3. 平衡质量(720p)")
             print("4. 低质量(节省带宽)")
-            preset_choice = input("请选择 (1-4): ")
+            print("5. 自动(按实测下载速度选择)")
+            preset_choice = input("请选择 (1-5): ")
             
-            preset_formats = {
-                "1": "bestvideo+bestaudio/best",
-                "2": "bestaudio/best",
-                "3": "bestvideo[height<=720]+bestaudio/best[height<=720]/best",
-                "4": "worstvideo+worstaudio/worst"
-            }
+            preset_formats = dict(zip("12345", PRESET_FORMATS.values()))
             
             if preset_choice in preset_formats:
                 selected_format = preset_formats[preset_choice]
             else:
                 print("无效选择，使用最佳质量")
-                selected_format = "bestvideo+bestaudio/best"
+                selected_format = PRESET_FORMATS['best']
         else:
             if not is_playlist:
                 # 获取单个视频的格式信息
                 print("正在获取视频信息...")
-                formats_info = get_available_formats(url)
+                formats_info = get_available_formats(url, session, cache)
                 
                 print(f"\n找到视频: {formats_info['title']}")
-                print(f"调试: formats_info内容: {formats_info}")
+                _debug(f"formats_info内容: { {k: v for k, v in formats_info.items() if k != 'info'} }")
                 
                 # 确保找到了格式
                 if not formats_info['video_formats'] and not formats_info['audio_formats']:
@@ -444,17 +3554,13 @@ def main():
                     print("4. 使用低质量(节省带宽)")
                     preset_choice = input("请选择 (1-4): ")
                     
-                    preset_formats = {
-                        "1": "bestvideo+bestaudio/best",
-                        "2": "bestaudio/best",
-                        "3": "bestvideo[height<=720]+bestaudio/best[height<=720]/best",
-                        "4": "worstvideo+worstaudio/worst"
-                    }
+                    preset_formats = dict(zip("1234", PRESET_FORMATS.values()))
                     
                     if preset_choice in preset_formats:
                         preset_format = preset_formats[preset_choice]
                         print(f"使用预设格式: {preset_format}")
-                        download_video(url, preset_format, output_path)
+                        download_video(url, preset_format, output_path, session=session,
+                                       info=formats_info['info'])
                         print(f"视频已下载到 {output_path if output_path else '当前目录'}")
                         return 0
                     else:
@@ -520,12 +3626,28 @@ def main():
             if output_choice.lower() == 'y':
                 output_path = input("请输入下载路径: ")
         
+        # 询问并发下载数
+        workers = 1
+        if is_playlist:
+            workers_choice = input("\n请输入同时下载的视频数量 (默认1): ")
+            try:
+                workers = max(1, int(workers_choice)) if workers_choice.strip() else 1
+            except ValueError:
+                print("输入无效，将逐个下载")
+        
         # 开始下载
         if is_playlist:
-            download_playlist(playlist_info, selected_format, output_path)
+            with DownloadIndex() as index:
+                download_playlist(playlist_info, selected_format, output_path, workers=workers,
+                                  session=session, cache=cache, index=index)
         else:
-            print(f"\n开始下载 '{formats_info['title']}'...")
-            download_video(url, selected_format, output_path)
+            if formats_info:
+                print(f"\n开始下载 '{formats_info['title']}'...")
+                download_video(url, selected_format, output_path, session=session,
+                               info=formats_info['info'])
+            else:
+                print(f"\n开始下载 '{url}'...")
+                download_video(url, selected_format, output_path, session=session, cache=cache)
             print(f"\n视频已成功下载到 {output_path if output_path else '当前目录'}")
         
     except Exception as e:
@@ -534,6 +3656,10 @@ def main():
         import traceback
         traceback.print_exc()
         return 1
+    finally:
+        print_cache_stats(cache)
+        cache.close()
+        session.close()
     
     return 0
 